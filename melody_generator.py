@@ -11,20 +11,14 @@ import aubio
 from aubio import sink
 from songmatch import *
 from song import *
+from notesegmenter import NoteSegmenter
+from songmanifest import discoverSongs
 from operator import itemgetter
 from pprint import PrettyPrinter
 pp = PrettyPrinter(indent=4)
 #from wavplayer import *
 from scipy.io.wavfile import read
 
-def convert_durations(ds):
-    start_time = ds[0][0]
-    durations = []
-    for i,d in enumerate(ds):
-        if i+1 < len(ds):
-            durations.append(d[1]-start_time)
-    return durations
-
 # pyaudio params
 wf = read('twinkle.wav')[1]
 buffer_size = 1024
@@ -51,10 +45,9 @@ thresh_low = 1
 start_len = 2
 pitch_diff_thresh = 1.5
 note_min_len = 5
-pitches = [[]]
-durations = [[]] # durations = [[t_start, t_end]...]
+# frame pitches to notes, segmenter.durations() holds [[t_start, t_end]...]
+segmenter = NoteSegmenter(thresh_low, thresh_high, start_len, pitch_diff_thresh, note_min_len)
 seq = []
-start = True
 UDS = False
 start_note = None
 time_counter = 0 # time recorded so far (in seconds)
@@ -71,7 +64,8 @@ startpt = None
 #              'Three Blind Mice': './musicbank/three_blind_mice.wav'}
 
 # song database
-allSongNames = ["twinkle","london_bridge","three_blind_mice","boat","lullaby","mary_had_a_little_lamb"]
+# every song of the musicbank with a melody and timestamps
+allSongNames = discoverSongs(required=('melody', 'timestamps'))
 songdb = SongDatabase(allSongNames)
 songdb.preprocessMelodies()
 
@@ -80,31 +74,20 @@ start_notes = songdb.getAllFirstNode()
 timestamps = songdb.getAllTimestamps()
 
 # song matcher
-song_matcher = SongsMatchNew(songs, timestamps)
+# weight of the rhythm term, sung inter-onset ratios against the song
+# timestamps. None matches on pitch intervals alone; off until the term is
+# measured on the musicbank recordings (noise_testw13.py --rhythm)
+rhythm_weight = None
+song_matcher = SongsMatchNew(songs, timestamps, rhythmWeight=rhythm_weight)
 
 # initialise pyaudio
 p = pyaudio.PyAudio()
 
-def append_new(l, n, d, tc, note_min_len=5):
-    if len(l[-1]) <= note_min_len:
-        l.pop()
-        d.pop()
-    else:
-        l[-1] = np.mean(l[-1])
-        d[-1].append(tc)
-    l.append(n)
-    d.append([tc])
-    return l, d
-
-
 def process_audio(in_data, frame_count, time_info, status):
     ''' callback function for pyaudio'''
-    global start
-    global pitches
     global seq
     global start_note
     global time_counter
-    global durations
     global keydiff
     global temporatio
     global startpt
@@ -122,44 +105,32 @@ def process_audio(in_data, frame_count, time_info, status):
     confidence = pitch_o.get_confidence()
 
     # process pitch information
-    if (pitch < thresh_low or pitch > thresh_high) and not start:
-        start = True
-        pitches, durations = append_new(pitches, [], durations, time_counter)
-    if pitch > thresh_low and pitch < thresh_high:
-        start = False
-        if len(pitches[-1]) < start_len and abs(pitch - pitches[-1]) > pitch_diff_thresh:
-                pitches[-1] = [pitch]
-                durations[-1] = [time_counter] # reset note-start time
-        else:
-            if abs(pitch - np.mean(pitches[-1])) > pitch_diff_thresh:
-                pitches, durations = append_new(pitches, [pitch], durations, time_counter)
-            else:
-                pitches[-1].append(pitch)
-                if not durations[-1]: # if start note
-                    durations[-1] = [time_counter]
+    event = segmenter.addFrame(pitch, time_counter)
 
     # if note ends
-    if len(pitches) > 2 :
+    if event is not None:
         if not seq: # if seq empty
-            start_note = pitches[-3]
+            start_note = event.previous.pitch
+        step = event.note.pitch - event.previous.pitch
         if UDS:
-            if (pitches[-2] - pitches[-3]) > 1.0:
+            if step > 1.0:
                 seq.append("U")
-            elif abs(pitches[-2] - pitches[-3]) <= 1.0:
+            elif abs(step) <= 1.0:
                 seq.append("S")
             else:
                 seq.append("D")
         else:
-            seq.append(int(pitches[-2]-pitches[-3]))
-        pitches.pop(0)
+            seq.append(event.interval)
 
         # add the obtained note to song_matcher to get probability
-        song_matcher.addNote([seq[-1]])
-        scores = song_matcher.getProbDic()
-        #pp.pprint(scores)
-        if max(scores.values()) > 0.8: # if confident enought about song
-            song = sorted(scores.items(), key=itemgetter(1))[-1][0]
-            converted_durations = convert_durations(durations)
+        # onset ratio of the note just ended to the one before it
+        ratio = onsetRatios([event.previous.onset, event.note.onset, event.note.offset])[0]
+        song_matcher.addNote([seq[-1]], ratio)
+        song, prob = song_matcher.best()
+        #pp.pprint(song_matcher.top(5))
+        if prob > 0.8: # if confident enought about song
+            # note end times from the first note start
+            converted_durations = segmenter.offsets - segmenter.onsets[0]
             keydiff, temporatio, startpt = song_matcher.getKeyTempo(song, start_notes[song], start_note, converted_durations)
             print("+++++++++++++")
             print("key difference: %f" %keydiff)
@@ -196,7 +167,7 @@ stream.stop_stream()
 stream.close()
 p.terminate()
 print(start_note)
-print(durations)
+print(segmenter.durations())
 print(seq)
 
 print(keydiff, temporatio, startpt)
@@ -0,0 +1,241 @@
+"""
+MIDI to catalog pipeline: every song's .mid is read with mido, its melody is
+reduced to one note at a time and timed through the tempo map of the file,
+and the intervals and note end times of all songs are written as a compiled
+catalog (see songcatalog.py). Songs are converted in a process pool, and a
+cache keyed by a hash of the input files lets re-runs convert only the songs
+that changed:
+
+    python midicatalog.py catalog.bin [midi directory] [--processes N]
+
+When a song has a name_stripped.mid holding its melody, that track is used,
+otherwise the melody track is guessed from name.mid.
+"""
+import glob
+import hashlib
+import multiprocessing
+import os
+import numpy as np
+from song import SONG_PATH
+from songcatalog import writeCatalog
+
+# bump when the conversion changes, so cached songs are converted again
+PIPELINE_VERSION = 1
+_DEFAULT_TEMPO = 500000 # microseconds per beat until the first set_tempo
+
+def tempoMap(mid):
+    '''
+    (MidiFile) -> (ticks, seconds, tempos)
+    the set_tempo changes of every track in absolute ticks, with the time in
+    seconds at which each takes effect. Always starts at tick 0
+    '''
+    changes = {}
+    for track in mid.tracks:
+        tick = 0
+        for msg in track:
+            tick += msg.time
+            if msg.type == 'set_tempo':
+                # a later track overrides a change on the same tick
+                changes[tick] = msg.tempo
+    if 0 not in changes:
+        changes[0] = _DEFAULT_TEMPO
+    ticks = np.array(sorted(changes), dtype=np.int64)
+    tempos = np.array([changes[t] for t in ticks], dtype=float)
+    seconds = np.zeros(len(ticks))
+    np.cumsum(np.diff(ticks) * tempos[:-1] / (1e6 * mid.ticks_per_beat), out=seconds[1:])
+    return ticks, seconds, tempos
+
+def ticksToSeconds(ticks, tmap, ticksPerBeat):
+    '''
+    convert an array of absolute ticks to seconds with a tempoMap
+    '''
+    mapTicks, seconds, tempos = tmap
+    ticks = np.asarray(ticks, dtype=np.int64)
+    k = np.searchsorted(mapTicks, ticks, 'right') - 1
+    return seconds[k] + (ticks - mapTicks[k]) * tempos[k] / (1e6 * ticksPerBeat)
+
+def trackNotes(track):
+    '''
+    (MidiTrack) -> (pitches, onsets, offsets)
+    the notes of a track in absolute ticks, ordered by onset. A note_off ends
+    the earliest sounding note of its pitch and channel
+    '''
+    tick = 0
+    sounding = {}
+    notes = []
+    for msg in track:
+        tick += msg.time
+        if msg.type == 'note_on' and msg.velocity > 0:
+            sounding.setdefault((msg.channel, msg.note), []).append(len(notes))
+            notes.append([msg.note, tick, None, msg.channel])
+        elif msg.type in ('note_on', 'note_off'):
+            started = sounding.get((msg.channel, msg.note))
+            if started:
+                notes[started.pop(0)][2] = tick
+    for note in notes:
+        if note[2] is None:
+            note[2] = tick # still sounding at the end of the track
+    notes = [n for n in notes if n[3] != 9] # no drums
+    notes.sort(key=lambda n: (n[1], -n[0]))
+    if not notes:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pitches, onsets, offsets, channels = (np.array(x) for x in zip(*notes))
+    return pitches, onsets.astype(np.int64), offsets.astype(np.int64)
+
+def skyline(pitches, onsets, offsets):
+    '''
+    reduce notes to a melody: the highest note starting on every onset tick,
+    leaving out notes that start below a melody note still sounding. A melody
+    note ends at the next one at the latest
+    '''
+    keep = []
+    for k in range(len(pitches)):
+        if keep:
+            last = keep[-1]
+            if onsets[k] == onsets[last]:
+                continue # notes are sorted by onset then falling pitch
+            if offsets[last] > onsets[k] and pitches[k] < pitches[last]:
+                continue
+        keep.append(k)
+    pitches, onsets, offsets = pitches[keep], onsets[keep], offsets[keep].copy()
+    offsets[:-1] = np.minimum(offsets[:-1], onsets[1:])
+    return pitches, onsets, offsets
+
+def melodyTrack(mid):
+    '''
+    index of the track most likely to hold the melody: the highest mean pitch
+    among the tracks with at least a quarter as many notes as the busiest
+    '''
+    counts = []
+    means = []
+    for track in mid.tracks:
+        pitches, onsets, offsets = trackNotes(track)
+        counts.append(len(np.unique(onsets)))
+        means.append(pitches.mean() if len(pitches) else -1)
+    assert(max(counts) > 0), "MIDICATALOG, no notes in the file"
+    candidates = [i for i, n in enumerate(counts) if n >= max(counts) / 4]
+    return max(candidates, key=lambda i: means[i])
+
+def songFromMidi(midfile, strippedfile=None):
+    '''
+    (str, str) -> (intervals, timestamps)
+    the melody of a song as semitone intervals and the end time in seconds of
+    every note. strippedfile, when given, holds the melody track; its ticks
+    are those of midfile, whose resolution and tempo map are used
+    '''
+    import mido
+    mid = mido.MidiFile(midfile)
+    if strippedfile is not None:
+        stripped = mido.MidiFile(strippedfile)
+        notes = [trackNotes(track) for track in stripped.tracks]
+        pitches, onsets, offsets = (np.concatenate(x) for x in zip(*notes))
+        order = np.lexsort((-pitches, onsets))
+        pitches, onsets, offsets = pitches[order], onsets[order], offsets[order]
+    else:
+        pitches, onsets, offsets = trackNotes(mid.tracks[melodyTrack(mid)])
+    pitches, onsets, offsets = skyline(pitches, onsets, offsets)
+    assert(len(pitches) >= 2), "MIDICATALOG, %s has fewer than two melody notes" % midfile
+    timestamps = ticksToSeconds(offsets, tempoMap(mid), mid.ticks_per_beat)
+    return np.diff(pitches).astype(float), timestamps
+
+def _inputs(name, midiDir):
+    midfile = os.path.join(midiDir, name + '.mid')
+    strippedfile = os.path.join(midiDir, name + '_stripped.mid')
+    return midfile, strippedfile if os.path.exists(strippedfile) else None
+
+def songHash(midfile, strippedfile=None):
+    '''
+    content hash of the input files of a song and of the pipeline version
+    '''
+    h = hashlib.sha1(b'%d' % PIPELINE_VERSION)
+    for filename in (midfile, strippedfile):
+        h.update(b'\0')
+        if filename is not None:
+            with open(filename, 'rb') as file:
+                h.update(file.read())
+    return h.hexdigest()
+
+def _convert(task):
+    name, midfile, strippedfile, digest = task
+    try:
+        intervals, timestamps = songFromMidi(midfile, strippedfile)
+    except Exception as e:
+        return name, digest, None, '%s: %s' % (type(e).__name__, e)
+    return name, digest, (intervals, timestamps), None
+
+def midiSongs(midiDir=SONG_PATH):
+    '''
+    names of the songs with a .mid in midiDir, sorted
+    '''
+    names = [os.path.basename(f)[:-4] for f in glob.glob(os.path.join(midiDir, '*.mid'))]
+    return sorted(name for name in names if not name.endswith('_stripped'))
+
+def buildFromMidi(filename, midiDir=SONG_PATH, allSongNames=None, processes=None, cacheDir=None):
+    '''
+    convert the MIDI files of allSongNames (every song in midiDir by default)
+    and write them to the catalog filename. Converted songs are kept in
+    cacheDir (filename + '.cache' by default) under their content hash, and
+    only songs whose files changed are converted again. Returns a dict with
+    the names of the 'converted', 'reused' and 'failed' songs, failures
+    mapping to their error
+    '''
+    if allSongNames is None:
+        allSongNames = midiSongs(midiDir)
+    if cacheDir is None:
+        cacheDir = filename + '.cache'
+    os.makedirs(cacheDir, exist_ok=True)
+    songs = {}
+    tasks = []
+    reused = []
+    failed = {}
+    for name in allSongNames:
+        midfile, strippedfile = _inputs(name, midiDir)
+        try:
+            digest = songHash(midfile, strippedfile)
+        except OSError as e:
+            failed[name] = '%s: %s' % (type(e).__name__, e)
+            continue
+        cached = os.path.join(cacheDir, name + '.npz')
+        if os.path.exists(cached):
+            with np.load(cached) as entry:
+                if str(entry['hash']) == digest:
+                    songs[name] = (entry['intervals'], entry['timestamps'])
+                    reused.append(name)
+                    continue
+        tasks.append((name, midfile, strippedfile, digest))
+    if processes == 1 or len(tasks) <= 1:
+        results = map(_convert, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_convert, tasks, 4)
+    converted = []
+    for name, digest, song, error in results:
+        if song is None:
+            failed[name] = error
+            continue
+        intervals, timestamps = song
+        np.savez(os.path.join(cacheDir, name + '.npz'), hash=digest, intervals=intervals, timestamps=timestamps)
+        songs[name] = song
+        converted.append(name)
+    if processes != 1 and len(tasks) > 1:
+        pool.close()
+        pool.join()
+    names = [name for name in allSongNames if name in songs]
+    writeCatalog(filename, names, [songs[name][0] for name in names], [songs[name][1] for name in names])
+    return {'converted': converted, 'reused': reused, 'failed': failed}
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="build a song catalog from MIDI files")
+    parser.add_argument('catalog')
+    parser.add_argument('mididir', nargs='?', default=SONG_PATH)
+    parser.add_argument('--processes', type=int, default=None, help="worker processes, every core by default")
+    parser.add_argument('--cache', default=None, help="cache directory, catalog.cache by default")
+    args = parser.parse_args()
+    t0 = time.perf_counter()
+    result = buildFromMidi(args.catalog, args.mididir, processes=args.processes, cacheDir=args.cache)
+    print("%d songs converted, %d unchanged, %d failed in %.1fs" % (len(result['converted']), len(result['reused']),
+          len(result['failed']), time.perf_counter() - t0))
+    for name, error in sorted(result['failed'].items()):
+        print("  %s: %s" % (name, error))
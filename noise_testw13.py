@@ -11,6 +11,8 @@ import aubio
 from aubio import sink
 from songmatch import *
 from song import *
+from notesegmenter import NoteSegmenter
+from songmanifest import discoverSongs
 from operator import itemgetter
 from pprint import PrettyPrinter
 pp = PrettyPrinter(indent=4)
@@ -18,14 +20,6 @@ from wavplayer import *
 from scipy.io.wavfile import read
 import wave
 
-def convert_durations(ds):
-    start_time = ds[0][0]
-    durations = []
-    for i,d in enumerate(ds):
-        if i+1 < len(ds):
-            durations.append(d[1]-start_time)
-    return durations
-
 
 # pyaudio params
 buffer_size = 1024
@@ -54,10 +48,9 @@ thresh_low = 1
 start_len = 2
 pitch_diff_thresh = 1.5
 note_min_len = 5
-pitches = [[]]
-durations = [[]] # durations = [[t_start, t_end]...]
+# frame pitches to notes, segmenter.durations() holds [[t_start, t_end]...]
+segmenter = NoteSegmenter(thresh_low, thresh_high, start_len, pitch_diff_thresh, note_min_len)
 seq = []
-start = True
 UDS = False
 start_note = None
 time_counter = 0 # time recorded so far (in seconds)
@@ -67,7 +60,10 @@ startpt = None
 matched_song = ""
 
 # song database
-allSongNames = ["twinkle","london_bridge","three_blind_mice","boat","lullaby","mary_had_a_little_lamb"]
+# the songs of the test recordings, kept fixed so that runs compare; a
+# missing file is reported before the test starts
+allSongNames = discoverSongs(required=('melody', 'timestamps'),
+                             names=["twinkle","london_bridge","three_blind_mice","boat","lullaby","mary_had_a_little_lamb"])
 songdb = SongDatabase(allSongNames)
 songdb.preprocessMelodies()
 songs = songdb.getAllMelody()
@@ -75,24 +71,16 @@ start_notes = songdb.getAllFirstNode()
 timestamps = songdb.getAllTimestamps()
 
 # song matcher
-song_matcher = SongsMatchNew(songs, timestamps)
-
-def append_new(l, n, d, tc, note_min_len=5):
-    if len(l[-1]) <= note_min_len:
-        l.pop()
-        d.pop()
-    else:
-        l[-1] = np.mean(l[-1])
-        d[-1].append(tc)
-    l.append(n)
-    d.append([tc])
-    return l, d
+# weight of the rhythm term, sung inter-onset ratios against the song
+# timestamps. None matches on pitch intervals alone
+parser = argparse.ArgumentParser(description="detection rate and notes to detection on the test recordings")
+parser.add_argument('--rhythm', type=float, nargs='?', const=3, default=None, metavar='WEIGHT',
+                    help="add the rhythm term with this weight (3 if not given)")
+rhythm_weight = parser.parse_args().rhythm
+song_matcher = SongsMatchNew(songs, timestamps, rhythmWeight=rhythm_weight)
 
 def reset():
-    global pitches
-    global durations
     global seq
-    global start
     global start_note
     global time_counter
     global song_matcher
@@ -101,13 +89,11 @@ def reset():
     global startpt
     global matched_song
     
-    pitches = [[]]
-    durations = [[]]
+    segmenter.reset()
     seq = []
-    start = True
     start_note = None
     time_counter = 0
-    song_matcher = SongsMatchNew(songs, timestamps)
+    song_matcher.reset()
     if detected:
         keydiff = None
         temporatio = None
@@ -116,12 +102,9 @@ def reset():
 
 
 def process_audio(signal):
-    global start
-    global pitches
     global seq
     global start_note
     global time_counter
-    global durations
     global keydiff
     global temporatio
     global startpt
@@ -137,45 +120,33 @@ def process_audio(signal):
     confidence = pitch_o.get_confidence()
 
     # process pitch information
-    if (pitch < thresh_low or pitch > thresh_high) and not start:
-        start = True
-        pitches, durations = append_new(pitches, [], durations, time_counter)
-    if pitch > thresh_low and pitch < thresh_high:
-        start = False
-        if len(pitches[-1]) < start_len and abs(pitch - pitches[-1]) > pitch_diff_thresh:
-                pitches[-1] = [pitch]
-                durations[-1] = [time_counter] # reset note-start time
-        else:
-            if abs(pitch - np.mean(pitches[-1])) > pitch_diff_thresh:
-                pitches, durations = append_new(pitches, [pitch], durations, time_counter)
-            else:
-                pitches[-1].append(pitch)
-                if not durations[-1]: # if start note
-                    durations[-1] = [time_counter]
+    event = segmenter.addFrame(pitch, time_counter)
 
     # if note ends
-    if len(pitches) > 2 :
+    if event is not None:
         if not seq: # if seq empty
-            start_note = pitches[-3]
+            start_note = event.previous.pitch
+        step = event.note.pitch - event.previous.pitch
         if UDS:
-            if (pitches[-2] - pitches[-3]) > 1.0:
+            if step > 1.0:
                 seq.append("U")
-            elif abs(pitches[-2] - pitches[-3]) <= 1.0:
+            elif abs(step) <= 1.0:
                 seq.append("S")
             else:
                 seq.append("D")
         else:
-            seq.append(int(pitches[-2]-pitches[-3]))
-        pitches.pop(0)
+            seq.append(event.interval)
 
         # add the obtained note to song_matcher to get probability
-        song_matcher.addNote([seq[-1]])
-        scores = song_matcher.getProbDic()
-        best_song = sorted(scores.items(), key=itemgetter(1))[-1][0]
-        #pp.pprint(scores)
-        if max(scores.values()) > 0.8 and best_song != "Others": # if confident enought about song
+        # onset ratio of the note just ended to the one before it
+        ratio = onsetRatios([event.previous.onset, event.note.onset, event.note.offset])[0]
+        song_matcher.addNote([seq[-1]], ratio)
+        best_song, best_prob = song_matcher.best()
+        #pp.pprint(song_matcher.top(5))
+        if song_matcher.confident(0.8): # if confident enought about song
             matched_song = best_song
-            converted_durations = convert_durations(durations)
+            # note end times from the first note start
+            converted_durations = segmenter.offsets - segmenter.onsets[0]
             keydiff, temporatio, startpt = song_matcher.getKeyTempo(matched_song, start_notes[matched_song], start_note, converted_durations)
 #            print("+++++++++++++")
 #            print("key difference: %f" %keydiff)
@@ -256,6 +227,7 @@ for i in range(6): # intensity of noise
 for score in scores:
     scores[score][0] = np.mean(scores[score][0])
     scores[score][1] = np.mean(scores[score][1])
+print("rhythm weight: %s" % rhythm_weight)
 print(scores)    
                         
                         
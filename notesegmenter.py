@@ -0,0 +1,134 @@
+'''
+Streaming segmentation of frame pitches into sung notes. A note is a run of
+voiced frames within pitch_diff_thresh semitones of its running mean; it
+ends on an unvoiced frame or a frame too far from the mean, and is dropped
+when it lasted note_min_len frames or less. Every frame costs O(1): the
+open note keeps a running sum, finished notes go to preallocated arrays.
+'''
+from collections import namedtuple
+import numpy as np
+
+Note = namedtuple('Note', ['pitch', 'onset', 'offset'])
+# a finished note and the one before it, interval is the semitone step
+# between them truncated to an int
+NoteEvent = namedtuple('NoteEvent', ['interval', 'previous', 'note'])
+
+class NoteSegmenter(object):
+    '''
+    Turns the pitch of every frame into notes. addFrame returns a NoteEvent
+    when a note ends after an earlier one, otherwise None. The finished notes
+    kept (see trimHistory) are in pitches, onsets and offsets
+    '''
+    def __init__(self, thresh_low=1, thresh_high=100, start_len=2, pitch_diff_thresh=1.5, note_min_len=5,
+                 capacity=256):
+        self.thresh_low = thresh_low
+        self.thresh_high = thresh_high
+        self.start_len = start_len
+        self.pitch_diff_thresh = pitch_diff_thresh
+        self.note_min_len = note_min_len
+        self._pitches = np.empty(capacity)
+        self._onsets = np.empty(capacity)
+        self._offsets = np.empty(capacity)
+        self.reset()
+
+    def reset(self):
+        '''
+        forget every note, as a new segmenter
+        '''
+        self._first = 0 # kept notes are _first:_count
+        self._count = 0
+        self._last = None # last finished note
+        self._silent = True
+        self._clearNote()
+        self.onset = None # start time of the open note, None before any frame
+
+    def _clearNote(self):
+        self._sum = 0.0
+        self._len = 0
+
+    @property
+    def numNotes(self):
+        return self._count - self._first
+
+    @property
+    def pitches(self):
+        return self._pitches[self._first:self._count]
+
+    @property
+    def onsets(self):
+        return self._onsets[self._first:self._count]
+
+    @property
+    def offsets(self):
+        return self._offsets[self._first:self._count]
+
+    def durations(self):
+        '''
+        [[t_start, t_end], ...] of the kept notes, as an array
+        '''
+        return np.column_stack((self.onsets, self.offsets))
+
+    def trimHistory(self, nkeep):
+        '''
+        keep only the last nkeep finished notes
+        '''
+        self._first = max(self._first, self._count - nkeep)
+
+    def _push(self, pitch, onset, offset):
+        if self._count == len(self._pitches):
+            n = self._count - self._first
+            if self._first >= n:
+                # trimmed notes leave room at the front
+                for a in (self._pitches, self._onsets, self._offsets):
+                    a[:n] = a[self._first:self._count]
+            else:
+                size = 2 * len(self._pitches)
+                self._pitches, self._onsets, self._offsets = (np.concatenate((a[self._first:self._count],
+                    np.empty(size - n))) for a in (self._pitches, self._onsets, self._offsets))
+            self._first = 0
+            self._count = n
+        self._pitches[self._count] = pitch
+        self._onsets[self._count] = onset
+        self._offsets[self._count] = offset
+        self._count += 1
+
+    def _endNote(self, time):
+        # close the open note at time and open the next one there
+        event = None
+        if self._len > self.note_min_len:
+            note = Note(self._sum / self._len, self.onset, time)
+            self._push(*note)
+            if self._last is not None:
+                event = NoteEvent(int(note.pitch - self._last.pitch), self._last, note)
+            self._last = note
+        self._clearNote()
+        self.onset = time
+        return event
+
+    def addFrame(self, pitch, time):
+        '''
+        add the pitch (midi) of the frame at time, return the NoteEvent of the
+        note that ended on it, if any
+        '''
+        event = None
+        voiced = self.thresh_low < pitch < self.thresh_high
+        if not voiced and not self._silent:
+            self._silent = True
+            event = self._endNote(time)
+        if voiced:
+            self._silent = False
+            if 0 < self._len < self.start_len and abs(pitch - self._sum / self._len) > self.pitch_diff_thresh:
+                # the note started on a wrong pitch, start it again
+                self._sum = float(pitch)
+                self._len = 1
+                self.onset = time
+            elif self._len and abs(pitch - self._sum / self._len) > self.pitch_diff_thresh:
+                event = self._endNote(time)
+                self._sum = float(pitch)
+                self._len = 1
+            else:
+                self._sum += pitch
+                self._len += 1
+                if self.onset is None:
+                    self.onset = time
+        return event
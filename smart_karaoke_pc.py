@@ -11,6 +11,8 @@ import aubio
 from aubio import sink
 from songmatch import *
 from song import *
+from notesegmenter import NoteSegmenter
+from songmanifest import discoverSongs
 from operator import itemgetter
 from pprint import PrettyPrinter
 pp = PrettyPrinter(indent=4)
@@ -18,14 +20,6 @@ from wavplayer import WavPlayer
 from scipy.io.wavfile import read
 import wave
 
-def convert_durations(ds):
-    start_time = ds[0][0]
-    durations = []
-    for i,d in enumerate(ds):
-        if i+1 < len(ds):
-            durations.append(d[1]-start_time)
-    return durations
-
 # if vocal input, set wf = None
 song_input = '../test_recording/mary_xiuyan_quiet.wav'
 wf = None#read(song_input)[1]
@@ -58,10 +52,9 @@ thresh_low = 1
 start_len = 2
 pitch_diff_thresh = 1.5
 note_min_len = 5
-pitches = [[]]
-durations = [[]] # durations = [[t_start, t_end]...]
+# frame pitches to notes, segmenter.durations() holds [[t_start, t_end]...]
+segmenter = NoteSegmenter(thresh_low, thresh_high, start_len, pitch_diff_thresh, note_min_len)
 seq = []
-start = True
 UDS = False
 start_note = None
 time_counter = 0 # time recorded so far (in seconds)
@@ -70,10 +63,16 @@ temporatio = None
 startpt = None
 detected = False
 matched_song = ""
+key_tempo = None # key/tempo estimate of the matched song, updated every note
+# long sessions: only the last history_notes sung notes, and only the notes that
+# ended in the last history_seconds, are kept for matching. None keeps all
+history_notes = 200
+history_seconds = None
 
 # song database
-#allSongNames = ["twinkle","london_bridge","three_blind_mice","boat","lullaby","mary_had_a_little_lamb"]
-allSongNames = ["let_it_go"]#, "twinkle","london_bridge","three_blind_mice","boat","lullaby","mary_had_a_little_lamb"]
+# every song of the musicbank that can be matched and played, the others
+# are reported before anything is loaded
+allSongNames = discoverSongs(required=('melody', 'timestamps', 'wav'))
 songdb = SongDatabase(allSongNames)
 songdb.preprocessMelodies()
 songs = songdb.getAllMelody()
@@ -81,7 +80,11 @@ start_notes = songdb.getAllFirstNode()
 timestamps = songdb.getAllTimestamps()
 
 # song matcher
-song_matcher = SongsMatchNew(songs, timestamps)
+# weight of the rhythm term, sung inter-onset ratios against the song
+# timestamps. None matches on pitch intervals alone; off until the term is
+# measured on the musicbank recordings (noise_testw13.py --rhythm)
+rhythm_weight = None
+song_matcher = SongsMatchNew(songs, timestamps, rhythmWeight=rhythm_weight)
 
 # load all songs
 allWavs = {}
@@ -94,26 +97,31 @@ input("Press Enter to continue...")
 # initialise pyaudio
 p = pyaudio.PyAudio()
 
-def append_new(l, n, d, tc, note_min_len=5):
-    if len(l[-1]) <= note_min_len:
-        l.pop()
-        d.pop()
-    else:
-        l[-1] = np.mean(l[-1])
-        d[-1].append(tc)
-    l.append(n)
-    d.append([tc])
-    return l, d
+def trim_history():
+    ''' drop the oldest notes from seq, segmenter and song_matcher '''
+    global seq
+    keep = len(seq)
+    if history_notes is not None:
+        keep = min(keep, history_notes)
+    if history_seconds is not None:
+        # notes that ended recently, note ends only grow
+        recent = np.count_nonzero(time_counter - segmenter.offsets <= history_seconds)
+        keep = min(keep, recent - 1)
+    keep = max(keep, 1)
+    if keep < len(seq):
+        song_matcher.trimHistory(keep)
+        if key_tempo is not None:
+            key_tempo.trimHistory(keep)
+        del seq[:len(seq) - keep]
+        # the notes of the kept intervals
+        segmenter.trimHistory(keep + 1)
 
 
 def process_audio(in_data, frame_count, time_info, status):
     ''' callback function for pyaudio'''
-    global start
-    global pitches
     global seq
     global start_note
     global time_counter
-    global durations
     global keydiff
     global temporatio
     global startpt
@@ -122,6 +130,7 @@ def process_audio(in_data, frame_count, time_info, status):
     global matched_song
     global player
     global song_matcher
+    global key_tempo
     global recorded_output
 
     time_counter += seconds_per_sample
@@ -139,34 +148,19 @@ def process_audio(in_data, frame_count, time_info, status):
     confidence = pitch_o.get_confidence()
 
     # process pitch information
-    if (pitch < thresh_low or pitch > thresh_high) and not start:
-        start = True
-        pitches, durations = append_new(pitches, [], durations, time_counter)
-    if pitch > thresh_low and pitch < thresh_high:
-        start = False
-        if len(pitches[-1]) < start_len and abs(pitch - pitches[-1]) > pitch_diff_thresh:
-                pitches[-1] = [pitch]
-                durations[-1] = [time_counter] # reset note-start time
-        else:
-            if abs(pitch - np.mean(pitches[-1])) > pitch_diff_thresh:
-                pitches, durations = append_new(pitches, [pitch], durations, time_counter)
-            else:
-                pitches[-1].append(pitch)
-                if not durations[-1]: # if start note
-                    durations[-1] = [time_counter]
+    event = segmenter.addFrame(pitch, time_counter)
 
     # check if user stopped
-    if len(durations) > 1:
-        if (time_counter - durations[-1][0]) > 3.0:
+    if segmenter.numNotes > 0:
+        if (time_counter - segmenter.onset) > 3.0:
             print("######### restarting #########")
             # reset all data
-            pitches = [[]]
-            durations = [[]]
+            segmenter.reset()
+            event = None
             seq = []
-            start = True
             start_note = None
             time_counter = 0
-            song_matcher = SongsMatchNew(songs, timestamps)
+            song_matcher.reset()
             if detected:
                 player.stop()
                 keydiff = None
@@ -174,34 +168,43 @@ def process_audio(in_data, frame_count, time_info, status):
                 startpt = None
                 detected = False
                 matched_song = ""
+                key_tempo = None
 
     # if note ends
-    if len(pitches) > 2 :
+    if event is not None:
         if not seq: # if seq empty
-            start_note = pitches[-3]
+            start_note = event.previous.pitch
+        step = event.note.pitch - event.previous.pitch
         if UDS:
-            if (pitches[-2] - pitches[-3]) > 1.0:
+            if step > 1.0:
                 seq.append("U")
-            elif abs(pitches[-2] - pitches[-3]) <= 1.0:
+            elif abs(step) <= 1.0:
                 seq.append("S")
             else:
                 seq.append("D")
         else:
-            seq.append(int(pitches[-2]-pitches[-3]))
-        pitches.pop(0)
+            seq.append(event.interval)
 
         # add the obtained note to song_matcher to get probability
-        song_matcher.addNote([seq[-1]])
-        scores = song_matcher.getProbDic()
-        best_song = sorted(scores.items(), key=itemgetter(1))[-1][0]
-        #pp.pprint(scores)
-        if max(scores.values()) > 0.8 and best_song != "Others" and not detected: # if confident enought about song
+        # onset ratio of the note just ended to the one before it
+        ratio = onsetRatios([event.previous.onset, event.note.onset, event.note.offset])[0]
+        song_matcher.addNote([seq[-1]], ratio)
+        best_song, best_prob = song_matcher.best()
+        #pp.pprint(song_matcher.top(5))
+        if detected:
+            # only the new note goes into the estimate
+            key_tempo.addNote(seq[-1], song_matcher.getMatchIndex(matched_song), (event.note.onset, event.note.offset))
+            keydiff, temporatio, startpt = key_tempo.getKeyTempo()
+            player.curr_file = matched_song
+        if song_matcher.confident(0.8) and not detected: # if confident enought about song
             matched_song = best_song
-            converted_durations = convert_durations(durations)
-            keydiff, temporatio, startpt = song_matcher.getKeyTempo(matched_song, start_notes[matched_song], start_note, converted_durations)
+            # caught up on the notes sung so far
+            key_tempo = song_matcher.getKeyTempoTracker(matched_song, start_notes[matched_song], start_note, segmenter.durations())
+            keydiff, temporatio, startpt = key_tempo.getKeyTempo()
             player.curr_file = matched_song
-            print(round(startpt*playrate))
-            player.navigate(round(startpt*playrate))
+            offset = songdb.getTimeline(matched_song).sampleOffset(startpt, playrate)
+            print(offset)
+            player.navigate(offset)
             player.time_stretch = temporatio #/ (2**(keydiff/4/12))
             #player.pitch_shift = keydiff/4
             player.play()
@@ -212,10 +215,7 @@ def process_audio(in_data, frame_count, time_info, status):
             print("song: %s" %matched_song)
             print("+++++++++++++")
             detected = True
-        if detected:
-            converted_durations = convert_durations(durations)
-            keydiff, temporatio, startpt = song_matcher.getKeyTempo(matched_song, start_notes[matched_song], start_note, converted_durations)
-            player.curr_file = matched_song
+        trim_history()
 
     g(signal, len(signal))
     return (in_data, pyaudio.paContinue)
@@ -252,7 +252,7 @@ stream.close()
 p.terminate()
 
 print(start_note)
-print(durations)
+print(segmenter.durations())
 print(seq)
 print(keydiff, temporatio, startpt)
 
@@ -5,6 +5,10 @@ Created on Fri Feb 23 14:29:34 2018
 @author: Xiuyan
 """
 
+from collections import OrderedDict
+from collections.abc import Mapping
+import numpy as np
+
 SONG_PATH = "musicbank/"
 
 class Song(object):
@@ -18,6 +22,7 @@ class Song(object):
         self.melodyfile = self.file.split('.')[0] + "_stripped.mid"
         self.pitch_diff = None
         self.timestamps = None
+        self.timeline = None
 
         # manual set
         self.firstnote = 60
@@ -25,6 +30,7 @@ class Song(object):
     def preprocess(self):
         self.fetchMelodyPitchDiff()
         self.fetchTimestamps()
+        self.timeline = Timeline(self.timestamps)
 
     def setFile(self, file):
         self.file = SONG_PATH + file
@@ -59,73 +65,213 @@ class Song(object):
 
 
 
+class Timeline(object):
+    """
+    Index of the notes of a song in time, built once from its timestamps (the
+    end time of every note, the first note starting at 0). Lookups bisect
+    sorted arrays and take a single time or an array of times
+    """
+    def __init__(self, timestamps):
+        self.ends = np.asarray(timestamps, dtype=float)
+        assert(np.all(np.diff(self.ends) >= 0)), "TIMELINE, timestamps are not sorted"
+        self.onsets = np.concatenate(([0.0], self.ends[:-1]))
+
+    def __len__(self):
+        return len(self.ends)
+
+    def noteAt(self, time):
+        # index of the note sounding at time, len(self) past the last note
+        return _scalar(time, np.searchsorted(self.ends, time, 'right'))
+
+    def numNotesBefore(self, time):
+        # notes started by time, counted as SongDatabase always has: the
+        # note ending exactly at time is not counted and all notes are from
+        # the last timestamp on
+        if len(self.ends) == 0:
+            # no timestamps, no notes to count
+            return _scalar(time, np.zeros(np.shape(time), dtype=np.int64))
+        count = np.searchsorted(self.ends[1:], time, 'right') + 1
+        count = np.where(np.asarray(time) >= self.ends[-1], len(self.ends), count)
+        count = np.where(np.asarray(time) < 0, 0, count)
+        return _scalar(time, count)
+
+    def noteTime(self, index):
+        # onset time of note index
+        return _scalar(index, self.onsets[index])
+
+    def noteEnd(self, index):
+        return _scalar(index, self.ends[index])
+
+    def sampleOffset(self, time, rate):
+        # sample of a recording played at rate samples a second
+        return _scalar(time, np.rint(np.asarray(time, dtype=float) * rate).astype(np.int64))
+
+def _scalar(query, result):
+    # lookups answer a single value with a Python number
+    if np.ndim(query) == 0:
+        return result.item()
+    return result
+
+class _SongView(Mapping):
+    """
+    Read-only name -> value mapping over the songs of a SongDatabase, values
+    are fetched through getter when looked up
+    """
+    def __init__(self, names, getter):
+        self._names = names
+        self._index = set(names)
+        self._getter = getter
+
+    def __getitem__(self, songname):
+        if songname not in self._index:
+            raise KeyError(songname)
+        return self._getter(songname)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, songname):
+        return songname in self._index
+
+    def __repr__(self):
+        return repr(dict(self))
+
 class SongDatabase(object):
     """
 
     Attributes:
-        songs:
+        songs: Song of every name. In lazy mode songs are created when first
+               used and only the cacheSize most recently used are kept
     """
-    def __init__(self, allSongNames):
-
-        self.songs = {}
-        for songname in allSongNames:
-            self.songs[songname] = Song(songname, songname + ".mid")
+    def __init__(self, allSongNames, lazy=False, cacheSize=32, catalog=None):
+        # lazy: melodies are read on first use and kept in compact arrays,
+        # timestamps and Song metadata are read on demand behind an LRU of
+        # cacheSize songs. catalog, a SongCatalog or its file name, replaces
+        # the txt files as the source of melodies and timestamps. A .sqlite or
+        # .db file name opens a SongStore
+        self.songNames = list(allSongNames)
+        self.lazy = lazy
+        self.cacheSize = cacheSize
+        if isinstance(catalog, str) and catalog.endswith(('.sqlite', '.db')):
+            from songstore import SongStore
+            catalog = SongStore(catalog)
+        elif isinstance(catalog, str):
+            from songcatalog import SongCatalog
+            catalog = SongCatalog(catalog)
+        self.catalog = catalog
+        self._melodies = {}
+        self._timestamps = OrderedDict()
+        self._timelines = OrderedDict()
+        if lazy:
+            self.songs = OrderedDict()
+        else:
+            self.songs = {}
+            for songname in allSongNames:
+                self.songs[songname] = Song(songname, songname + ".mid")
+        self._melodyView = _SongView(self.songNames, self.getMelody)
+        self._timestampView = _SongView(self.songNames, self.getTimestamps)
 
     def preprocessMelodies(self):
-
+        # lazy and catalog backed databases read on demand
+        if self.lazy or self.catalog is not None:
+            return
         for songname in self.songs.keys():
             self.songs[songname].preprocess()
 
+    def getSong(self, songname):
+        if not self.lazy:
+            return self.songs[songname]
+        song = self.songs.get(songname)
+        if song is None:
+            assert(songname in self._melodyView), "SONGDATABASE, unknown song %s" % songname
+            song = Song(songname, songname + ".mid")
+            self.songs[songname] = song
+            if len(self.songs) > self.cacheSize:
+                self.songs.popitem(last=False)
+        else:
+            self.songs.move_to_end(songname)
+        return song
+
     def getMelody(self, songname):
-        return self.songs[songname].pitch_diff
+        if self.catalog is not None:
+            return self.catalog.getMelody(songname)
+        if not self.lazy:
+            return self.songs[songname].pitch_diff
+        melody = self._melodies.get(songname)
+        if melody is None:
+            song = self.getSong(songname)
+            song.fetchMelodyPitchDiff()
+            melody = np.array(song.pitch_diff, dtype=np.float32)
+            song.pitch_diff = None
+            self._melodies[songname] = melody
+        return melody
 
     def getAllMelody(self):
-        melodydic = {}
-        for songname in self.songs.keys():
-            melodydic[songname] = self.songs[songname].pitch_diff
-        return melodydic
+        return self._melodyView
 
     def getFirstNote(self, songname):
-        return self.songs[songname].firstnote
+        return self.getSong(songname).firstnote
 
     def getAllFirstNode(self):
         firstnotedic = {}
-        for songname in self.songs.keys():
+        for songname in self.songNames:
             #firstnotedic[songname] = self.songs[songname].firstnote
             firstnotedic[songname] = 60
         return firstnotedic
 
     def getTimestamps(self, songname):
-        return self.songs[songname].timestamps
+        if not self.lazy and self.catalog is None:
+            return self.songs[songname].timestamps
+        return self._cached(self._timestamps, songname, self._readTimestamps)
+
+    def _readTimestamps(self, songname):
+        if self.catalog is not None:
+            return self.catalog.getTimestamps(songname)
+        song = self.getSong(songname)
+        song.fetchTimestamps()
+        timestamps = song.timestamps
+        song.timestamps = None
+        return timestamps
+
+    def _cached(self, cache, songname, read):
+        # LRU of the cacheSize most recently used songs
+        value = cache.get(songname)
+        if value is None:
+            value = read(songname)
+            cache[songname] = value
+            if len(cache) > self.cacheSize:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(songname)
+        return value
+
+    def getTimeline(self, songname):
+        if not self.lazy and self.catalog is None:
+            song = self.songs[songname]
+            if song.timeline is None:
+                song.timeline = Timeline(song.timestamps)
+            return song.timeline
+        return self._cached(self._timelines, songname, lambda name: Timeline(self.getTimestamps(name)))
 
     def getAllTimestamps(self):
-        timestampsdic = {}
-        for songname in self.songs.keys():
-            timestampsdic[songname] = self.songs[songname].timestamps
-        return timestampsdic
+        return self._timestampView
 
     def getNumNotesBefore(self, songname, timestamp):
-        timestamps = self.songs[songname].timestamps
-        if timestamp >= timestamps[-1]:
-            return len(timestamps)
-        i = 0
-        t = 0
-        numnotes = 0
-        while t <= timestamp:
-            numnotes += 1
-            i += 1
-            t = timestamps[i]
-        return numnotes
+        return self.getTimeline(songname).numNotesBefore(timestamp)
 
     def getMIDI(self, songname):
-        return self.songs[songname].getMIDI()
+        return self.getSong(songname).getMIDI()
 
     def getWAV(self, songname):
-        return self.songs[songname].getWAV()
+        return self.getSong(songname).getWAV()
 
 if __name__ == "__main__":
 
-    allSongNames = ["twinkle","london_bridge","three_blind_mice","boat","lullaby","mary_had_a_little_lamb"]
+    from songmanifest import discoverSongs
+    allSongNames = discoverSongs()
 
     songdb = SongDatabase(allSongNames)
     songdb.preprocessMelodies()
@@ -0,0 +1,124 @@
+"""
+Offline identification of many recorded queries at once, for regression runs
+and parameter tuning. Every worker process loads the catalog once and then
+runs whole queries through its own matcher.
+"""
+import multiprocessing
+from songmatch import SongsMatchNew, onsetRatios
+from song import SongDatabase
+
+# per worker catalog, filled in by _initWorker
+_worker = {}
+
+def _initWorker(allSongNames, matcherClass, threshold, rhythmWeight):
+    songdb = SongDatabase(allSongNames)
+    songdb.preprocessMelodies()
+    _worker['songs'] = songdb.getAllMelody()
+    _worker['timestamps'] = songdb.getAllTimestamps()
+    _worker['start_notes'] = songdb.getAllFirstNode()
+    _worker['matcherClass'] = matcherClass
+    _worker['threshold'] = threshold
+    _worker['rhythmWeight'] = rhythmWeight
+
+def _identify(task):
+    seq, durations, start_note = task
+    rhythmWeight = _worker['rhythmWeight']
+    song_matcher = _worker['matcherClass'](_worker['songs'], _worker['timestamps'], rhythmWeight=rhythmWeight)
+    threshold = _worker['threshold']
+    ratios = [None] * len(seq)
+    if rhythmWeight is not None and durations is not None:
+        # the last sung note ends where a next one would start
+        ratios = onsetRatios([d[0] for d in durations] + [durations[-1][1]])
+    detected = None
+    matched_song = None
+    for i, (note, ratio) in enumerate(zip(seq, ratios)):
+        song_matcher.addNote([note], ratio)
+        best_song, best_prob = song_matcher.best()
+        # same rule as the live detection in smart_karaoke.py
+        if detected is None and best_prob > threshold and best_song != "Others":
+            detected = i + 1
+            matched_song = best_song
+    scores = dict(song_matcher.getProbDic())
+    best_song = song_matcher.best()[0]
+    keytempo = None
+    song = matched_song if matched_song is not None else best_song
+    if durations is not None and song != "Others":
+        # end time of every sung note, relative to the start of the first one
+        assert(len(durations) == len(seq) + 1), "SONGBATCH, need one duration per sung note"
+        ttime = [d[1] - durations[0][0] for d in durations]
+        sfkey = _worker['start_notes'][song]
+        tfkey = start_note if start_note is not None else sfkey
+        keytempo = song_matcher.getKeyTempo(song, sfkey, tfkey, ttime)
+    return {'probs': scores, 'best': best_song, 'detected': detected,
+            'song': matched_song, 'keytempo': keytempo}
+
+def identifyBatch(allSongNames, queries, durations=None, start_notes=None,
+                  processes=None, matcherClass=SongsMatchNew, threshold=0.8, chunksize=8,
+                  rhythmWeight=None):
+    '''
+    Run every query (a list of sung intervals) through its own matcher.
+
+    durations holds, per query, the [t_start, t_end] of every sung note (one more
+    than the intervals) and start_notes the first sung MIDI pitch; both are only
+    needed for the key/tempo estimate, durations also feed the rhythm term when
+    rhythmWeight is set (see SongMatchNew). Returns one dict per query with the final
+    probabilities ('probs'), the best song ('best'), the note count at which
+    the detection threshold was first crossed ('detected', None if never), the
+    detected song ('song') and its getKeyTempo output ('keytempo').
+    processes=1 runs in this process, None uses every core
+    '''
+    n = len(queries)
+    if durations is None:
+        durations = [None] * n
+    if start_notes is None:
+        start_notes = [None] * n
+    assert(len(durations) == n and len(start_notes) == n), "SONGBATCH, one entry per query expected"
+    tasks = list(zip(queries, durations, start_notes))
+    initargs = (allSongNames, matcherClass, threshold, rhythmWeight)
+    if processes == 1:
+        _initWorker(*initargs)
+        return [_identify(task) for task in tasks]
+    with multiprocessing.Pool(processes, initializer=_initWorker, initargs=initargs) as pool:
+        return pool.map(_identify, tasks, chunksize)
+
+if __name__ == "__main__":
+    import time
+    import numpy as np
+    from songindex import noisyQuery, noisyPerformance
+
+    allSongNames = ["twinkle","london_bridge","three_blind_mice","boat","lullaby","mary_had_a_little_lamb"]
+    songdb = SongDatabase(allSongNames)
+    songdb.preprocessMelodies()
+    rng = np.random.RandomState(0)
+    queries = []
+    truths = []
+    for k in range(600):
+        truth = allSongNames[rng.randint(len(allSongNames))]
+        queries.append(noisyQuery(songdb.getMelody(truth), 20, rng))
+        truths.append(truth)
+
+    for processes in sorted(set([1, 2, multiprocessing.cpu_count()])):
+        t0 = time.perf_counter()
+        results = identifyBatch(allSongNames, queries, processes=processes)
+        elapsed = time.perf_counter() - t0
+        correct = sum(r['song'] == truth for r, truth in zip(results, truths))
+        print("%d processes: %.0f queries/s, %d/%d detected correctly"
+              % (processes, len(queries)/elapsed, correct, len(queries)))
+
+    # notes sung until the right song is detected, with and without the rhythm
+    # term, on performances at random tempi. A miss counts as qlen + 1 notes
+    qlen = 30
+    performances = []
+    truths = []
+    for k in range(600):
+        truth = allSongNames[rng.randint(len(allSongNames))]
+        performances.append(noisyPerformance(songdb.getMelody(truth), songdb.getTimestamps(truth), qlen, rng))
+        truths.append(truth)
+    queries = [q for q, d in performances]
+    durations = [d for q, d in performances]
+    for rhythmWeight in (None, 3):
+        results = identifyBatch(allSongNames, queries, durations, processes=1, rhythmWeight=rhythmWeight)
+        notes = np.array([r['detected'] if r['song'] == truth else qlen + 1 for r, truth in zip(results, truths)])
+        wrong = sum(r['song'] not in (None, truth) for r, truth in zip(results, truths))
+        print("rhythm weight %s: notes to detection mean %.2f, median %.0f, p90 %.0f, %d wrong detections"
+              % (rhythmWeight, notes.mean(), np.median(notes), np.percentile(notes, 90), wrong))
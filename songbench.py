@@ -0,0 +1,181 @@
+"""
+Benchmark of the catalog matchers on synthetic catalogs. For every backend
+and catalog size it measures the per-note update latency, the memory held
+per song and the identification accuracy on noisy queries, and writes one
+JSON object per line so runs can be compared over time:
+
+    python songbench.py --songs 100,1000 --backends SongsMatchNew,SongsMatchBatch
+
+New backends are added to BACKENDS: a name and a function building a matcher
+from the song dictionary. Matchers are reused across queries through reset
+when they have it, and closed with close when they have it.
+"""
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+import numpy as np
+from songmatch import SongsMatch, SongsMatchNew, SongsMatchBatch
+from songindex import SongsMatchIndexed, syntheticCatalog, noisyQuery
+
+def _shardedMatcher(dic):
+    from songshard import SongsMatchSharded
+    return SongsMatchSharded(dic, nshards=2)
+
+BACKENDS = {
+    'SongsMatch': SongsMatch,
+    'SongsMatchNew': SongsMatchNew,
+    'SongsMatchNew-pruned': lambda dic: SongsMatchNew(dic, margin=30, suspendProb=1e-6),
+    'SongsMatchBatch': SongsMatchBatch,
+    'SongsMatchIndexed': SongsMatchIndexed,
+    'SongsMatchSharded': _shardedMatcher,
+}
+
+# backends whose songs live in worker processes, memory is only traced in
+# this one
+OUT_OF_PROCESS = {'SongsMatchSharded'}
+
+# the unit cost SongsMatch scans every song in Python and is left out by default
+DEFAULT_BACKENDS = ['SongsMatchNew', 'SongsMatchNew-pruned', 'SongsMatchBatch', 'SongsMatchIndexed']
+
+def makeQueries(dic, nquery, length, rng, perr=0.1, unknown=0.1):
+    '''
+    nquery noisy queries of length intervals, with their true song. A fraction
+    unknown of them comes from songs outside dic, their true song is None
+    '''
+    names = list(dic)
+    outside = syntheticCatalog(max(1, int(nquery * unknown)), seed=rng.randint(1 << 30))
+    outsideNames = list(outside)
+    queries = []
+    for k in range(nquery):
+        if rng.rand() < unknown:
+            queries.append((noisyQuery(outside[outsideNames[rng.randint(len(outsideNames))]], length, rng, perr), None))
+        else:
+            truth = names[rng.randint(len(names))]
+            queries.append((noisyQuery(dic[truth], length, rng, perr), truth))
+    return queries
+
+def _best(matcher):
+    if hasattr(matcher, 'best'):
+        return matcher.best()
+    probs = matcher.getProbDic()
+    best = max(probs, key=probs.get)
+    return best, probs[best]
+
+def _measureMemory(factory, dic, query):
+    # bytes held by a matcher caught up on one query, and the peak on the way
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    matcher = factory(dic)
+    for note in query:
+        matcher.addNote([note])
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if hasattr(matcher, 'close'):
+        matcher.close()
+    return current - base, peak - base
+
+def runBackend(name, dic, queries, threshold=0.8):
+    '''
+    return the benchmark record of one backend over one catalog
+    '''
+    factory = BACKENDS[name]
+    nsong = len(dic)
+    memory, peak = _measureMemory(factory, dic, queries[0][0])
+    t0 = time.perf_counter()
+    matcher = factory(dic)
+    build = time.perf_counter() - t0
+    latency = []
+    top1 = 0
+    detected = 0
+    wrong = 0
+    notes = []
+    for k, (query, truth) in enumerate(queries):
+        if k > 0:
+            if hasattr(matcher, 'reset'):
+                matcher.reset()
+            else:
+                matcher = factory(dic)
+        found = None
+        for i, note in enumerate(query):
+            t0 = time.perf_counter()
+            matcher.addNote([note])
+            latency.append(time.perf_counter() - t0)
+            song, prob = _best(matcher)
+            # same rule as the live detection in smart_karaoke.py
+            if found is None and song != 'Others' and prob > threshold:
+                found = song
+                if found == truth:
+                    notes.append(i + 1)
+        song, prob = _best(matcher)
+        top1 += song == (truth if truth is not None else 'Others')
+        if found is not None:
+            if found == truth:
+                detected += 1
+            else:
+                wrong += 1
+    if hasattr(matcher, 'close'):
+        matcher.close()
+    latency = 1e3 * np.array(latency)
+    known = sum(truth is not None for query, truth in queries)
+    return {
+        'backend': name,
+        'songs': nsong,
+        'queries': len(queries),
+        'build_s': build,
+        'memory_bytes_per_song': memory / nsong,
+        'peak_bytes_per_song': peak / nsong,
+        'memory_excludes_workers': name in OUT_OF_PROCESS,
+        'latency_ms': {'p50': float(np.percentile(latency, 50)), 'p95': float(np.percentile(latency, 95)),
+                       'p99': float(np.percentile(latency, 99)), 'mean': float(latency.mean())},
+        'top1': top1 / len(queries),
+        'detection_rate': detected / known if known else None,
+        'wrong_detections': wrong,
+        'notes_to_detection': float(np.mean(notes)) if notes else None,
+    }
+
+def runBenchmark(sizes, backends=DEFAULT_BACKENDS, minlen=40, maxlen=150, querylen=20,
+                 nquery=50, perr=0.1, unknown=0.1, seed=0, output=None):
+    '''
+    run every backend on a synthetic catalog of every size in sizes and return
+    the records, each also written as a line of JSON to output (a file object)
+    '''
+    for name in backends:
+        assert(name in BACKENDS), "SONGBENCH, unknown backend %s" % name
+    records = []
+    for nsong in sizes:
+        dic = syntheticCatalog(nsong, minlen, maxlen, seed)
+        rng = np.random.RandomState(seed + 1)
+        queries = makeQueries(dic, nquery, querylen, rng, perr, unknown)
+        for name in backends:
+            record = runBackend(name, dic, queries)
+            record.update({'min_len': minlen, 'max_len': maxlen, 'query_len': querylen, 'perr': perr,
+                           'unknown': unknown, 'seed': seed, 'python': platform.python_version(),
+                           'numpy': np.__version__, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
+            records.append(record)
+            if output is not None:
+                output.write(json.dumps(record) + '\n')
+                output.flush()
+    return records
+
+if __name__ == "__main__":
+    import sys
+    parser = argparse.ArgumentParser(description="per-note latency, memory and accuracy of the song matchers")
+    parser.add_argument('--songs', default='100,1000', help="comma separated catalog sizes")
+    parser.add_argument('--backends', default=','.join(DEFAULT_BACKENDS),
+                        help="comma separated, out of " + ', '.join(BACKENDS))
+    parser.add_argument('--min-len', type=int, default=40, help="shortest melody, in intervals")
+    parser.add_argument('--max-len', type=int, default=150, help="longest melody, in intervals")
+    parser.add_argument('--query-len', type=int, default=20, help="intervals per query before noise")
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--perr', type=float, default=0.1, help="insertion, deletion and +-1 error rate")
+    parser.add_argument('--unknown', type=float, default=0.1, help="fraction of queries from songs outside the catalog")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="append the JSON lines to this file instead of printing them")
+    args = parser.parse_args()
+    out = open(args.output, 'a') if args.output else sys.stdout
+    runBenchmark([int(n) for n in args.songs.split(',')], args.backends.split(','), args.min_len, args.max_len,
+                 args.query_len, args.queries, args.perr, args.unknown, args.seed, out)
+    if args.output:
+        out.close()
@@ -0,0 +1,188 @@
+"""
+Compiled song catalog: the intervals and timestamps of every song in one
+binary file, opened with np.memmap so loading takes constant time and the
+pages are shared by every process reading the same file.
+
+Layout, little endian, every section starting on an 8 byte boundary:
+    header       magic, version, number of songs, of intervals, of
+                 timestamps, bytes of names
+    int offsets  int64[nsong+1], song i has intervals[off[i]:off[i+1]]
+    time offsets int64[nsong+1], the same for timestamps
+    intervals    float32
+    timestamps   float64
+    names        utf-8, one per line
+Build it from the musicbank text files with
+    python songcatalog.py build catalog.bin [song names]
+"""
+import glob
+import os
+from collections import OrderedDict
+import numpy as np
+from song import SONG_PATH, Timeline
+
+_MAGIC = b'SKCATLOG'
+_VERSION = 1
+_HEADER = np.dtype([('magic', 'S8'), ('version', '<i8'), ('nsong', '<i8'), ('nint', '<i8'),
+                    ('ntime', '<i8'), ('nname', '<i8')])
+
+def _align(n):
+    return (n + 7) // 8 * 8
+
+def _readFloats(filename):
+    # one line of comma separated numbers, as written by the preprocessing
+    with open(filename, 'r') as file:
+        line = file.readline().strip()
+    return np.array(line.split(','), dtype=float) if line else np.zeros(0)
+
+def musicbankSongs(songPath=SONG_PATH):
+    '''
+    names of the songs with a melody file in songPath, sorted
+    '''
+    suffix = '_stripped.txt'
+    return sorted(os.path.basename(f)[:-len(suffix)] for f in glob.glob(os.path.join(songPath, '*' + suffix)))
+
+def writeCatalog(filename, names, melodies, timestamps):
+    '''
+    write the catalog of the songs names, melodies and timestamps holding one
+    sequence per song (an empty one for a song without timestamps)
+    '''
+    assert(len(names) == len(melodies) == len(timestamps)), "SONGCATALOG, one melody and timestamps per song"
+    assert(all('\n' not in name for name in names)), "SONGCATALOG, song names cannot hold newlines"
+    nsong = len(names)
+    intOffsets = np.zeros(nsong + 1, dtype='<i8')
+    np.cumsum([len(m) for m in melodies], out=intOffsets[1:])
+    timeOffsets = np.zeros(nsong + 1, dtype='<i8')
+    np.cumsum([len(t) for t in timestamps], out=timeOffsets[1:])
+    nameBytes = '\n'.join(names).encode('utf-8')
+    header = np.zeros(1, dtype=_HEADER)
+    header[0] = (_MAGIC, _VERSION, nsong, intOffsets[-1], timeOffsets[-1], len(nameBytes))
+    sections = [header.tobytes(), intOffsets.tobytes(), timeOffsets.tobytes(),
+                np.concatenate([np.zeros(0)] + [np.asarray(m, dtype=float) for m in melodies]).astype('<f4').tobytes(),
+                np.concatenate([np.zeros(0)] + [np.asarray(t, dtype=float) for t in timestamps]).astype('<f8').tobytes(),
+                nameBytes]
+    # written next to the target and renamed, readers never see half a file
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as file:
+        for section in sections:
+            file.write(section)
+            file.write(b'\0' * (_align(len(section)) - len(section)))
+    os.replace(tmp, filename)
+
+def buildCatalog(filename, allSongNames=None, songPath=SONG_PATH):
+    '''
+    compile the _stripped.txt and _timestamps.txt files of allSongNames (every
+    song of songPath by default) into the catalog filename
+    '''
+    if allSongNames is None:
+        allSongNames = musicbankSongs(songPath)
+    melodies = []
+    timestamps = []
+    for name in allSongNames:
+        melodies.append(_readFloats(os.path.join(songPath, name + '_stripped.txt')))
+        timefile = os.path.join(songPath, name + '_timestamps.txt')
+        timestamps.append(_readFloats(timefile) if os.path.exists(timefile) else np.zeros(0))
+    writeCatalog(filename, list(allSongNames), melodies, timestamps)
+
+class SongCatalog(object):
+    """
+    Read-only SongDatabase over a compiled catalog file. Melodies and
+    timestamps are array views into the mapped file, nothing is read until
+    it is used. The Timelines of the cacheSize most recently used songs are
+    kept
+    """
+    def __init__(self, filename, songPath=SONG_PATH, cacheSize=32):
+        self.filename = filename
+        self.songPath = songPath
+        self.cacheSize = cacheSize
+        self._map = np.memmap(filename, dtype=np.uint8, mode='r')
+        header = self._map[:_HEADER.itemsize].view(_HEADER)[0]
+        assert(header['magic'] == _MAGIC), "SONGCATALOG, %s is not a song catalog" % filename
+        assert(header['version'] == _VERSION), "SONGCATALOG, unsupported catalog version"
+        nsong, nint, ntime, nname = (int(header[k]) for k in ('nsong', 'nint', 'ntime', 'nname'))
+        pos = _align(_HEADER.itemsize)
+        self._intOffsets, pos = self._section(pos, '<i8', nsong + 1)
+        self._timeOffsets, pos = self._section(pos, '<i8', nsong + 1)
+        self._intervals, pos = self._section(pos, '<f4', nint)
+        self._timestamps, pos = self._section(pos, '<f8', ntime)
+        self._names = self._map[pos:pos + nname]
+        self._songNames = None
+        self._songIndex = None
+        self._timelines = OrderedDict()
+
+    def _section(self, pos, dtype, n):
+        size = np.dtype(dtype).itemsize * n
+        return self._map[pos:pos + size].view(dtype), pos + _align(size)
+
+    def getNumSongs(self):
+        return len(self._intOffsets) - 1
+
+    @property
+    def songNames(self):
+        # decoded on first use
+        if self._songNames is None:
+            self._songNames = self._names.tobytes().decode('utf-8').split('\n') if len(self._names) else []
+        return self._songNames
+
+    @property
+    def songIndex(self):
+        if self._songIndex is None:
+            self._songIndex = {name: i for i, name in enumerate(self.songNames)}
+        return self._songIndex
+
+    def getMelodyAt(self, i):
+        return self._intervals[self._intOffsets[i]:self._intOffsets[i+1]]
+
+    def getTimestampsAt(self, i):
+        return self._timestamps[self._timeOffsets[i]:self._timeOffsets[i+1]]
+
+    def getMelody(self, songname):
+        return self.getMelodyAt(self.songIndex[songname])
+
+    def getAllMelody(self):
+        return {name: self.getMelodyAt(i) for i, name in enumerate(self.songNames)}
+
+    def getTimestamps(self, songname):
+        return self.getTimestampsAt(self.songIndex[songname])
+
+    def getAllTimestamps(self):
+        # songs without timestamps are left out, as matchers expect
+        return {name: self.getTimestampsAt(i) for i, name in enumerate(self.songNames)
+                if self._timeOffsets[i+1] > self._timeOffsets[i]}
+
+    def getFirstNote(self, songname):
+        return 60
+
+    def getAllFirstNode(self):
+        return {name: 60 for name in self.songNames}
+
+    def getTimeline(self, songname):
+        # built on first use over the mapped timestamps, LRU of cacheSize
+        timeline = self._timelines.get(songname)
+        if timeline is None:
+            timeline = self._timelines[songname] = Timeline(self.getTimestamps(songname))
+            if len(self._timelines) > self.cacheSize:
+                self._timelines.popitem(last=False)
+        else:
+            self._timelines.move_to_end(songname)
+        return timeline
+
+    def getNumNotesBefore(self, songname, timestamp):
+        return self.getTimeline(songname).numNotesBefore(timestamp)
+
+    def getMIDI(self, songname):
+        return os.path.join(self.songPath, songname + ".mid")
+
+    def getWAV(self, songname):
+        return os.path.join(self.songPath, songname + ".wav")
+
+if __name__ == "__main__":
+    import sys
+    import time
+    if len(sys.argv) >= 3 and sys.argv[1] == 'build':
+        names = sys.argv[3:] or None
+        t0 = time.perf_counter()
+        buildCatalog(sys.argv[2], names)
+        catalog = SongCatalog(sys.argv[2])
+        print("%d songs written to %s in %.2fs" % (catalog.getNumSongs(), sys.argv[2], time.perf_counter() - t0))
+    else:
+        print("usage: python songcatalog.py build catalog.bin [song names]")
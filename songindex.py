@@ -0,0 +1,302 @@
+import numpy as np
+from songmatch import SongMatchNew, NameView, _Posterior
+
+# intervals are clipped to +-(_RADIX//2 - 2) semitones before being packed into gram
+# keys, which leaves room for the +-1 error variants
+_RADIX = 64
+
+class IntervalIndex:
+    '''
+    Inverted index over the interval n-grams of every song. Posting lists are
+    stored CSR style: the sorted distinct gram keys, and for every key a slice
+    of song ids in one flat array
+    '''
+    def __init__(self, dic, n=3):
+        assert(len(dic) > 0), "SONGINDEX, song dictionary is empty!"
+        self.n = n
+        self.songNames = list(dic)
+        nsong = len(self.songNames)
+        keys = []
+        ids = []
+        for i, name in enumerate(self.songNames):
+            g = self._keys(dic[name])
+            keys.append(g)
+            ids.append(np.full(len(g), i, dtype=np.int32))
+        keys = np.concatenate(keys)
+        ids = np.concatenate(ids)
+        # one posting per (gram, song) pair
+        pairs = np.unique(keys * nsong + ids)
+        keys = pairs // nsong
+        self.postings = (pairs % nsong).astype(np.int32)
+        self.keys, self.offsets = np.unique(keys, return_index=True)
+        self.offsets = np.append(self.offsets, len(keys))
+        df = np.diff(self.offsets)
+        # rare grams say more about the song than common ones
+        self.idf = np.log(1.0 + nsong/df)
+        # every combination of -1/0/+1 semitone errors over a gram
+        self._errors = np.array(np.meshgrid(*[[-1,0,1]]*n, indexing='ij')).reshape(n, -1).T
+        self._errorWeight = 1.0/(1 + np.abs(self._errors).sum(axis=1))
+        self._errorKeys = self._pack(self._errors)
+
+    def _pack(self, grams):
+        # grams: (..., n) array of offset-free intervals -> int64 keys
+        return (grams * (_RADIX ** np.arange(self.n))).sum(axis=-1)
+
+    def _keys(self, s):
+        s = np.clip(np.rint(np.asarray(s, dtype=float)), -(_RADIX//2 - 2), _RADIX//2 - 2).astype(np.int64)
+        if len(s) < self.n:
+            return np.zeros(0, dtype=np.int64)
+        windows = np.lib.stride_tricks.sliding_window_view(s + _RADIX//2, self.n)
+        return self._pack(windows)
+
+    def getNumSongs(self):
+        return len(self.songNames)
+
+    def scoreGram(self, gram, scores):
+        '''
+        (list, array) -> None
+        Add the evidence of one sung n-gram to the per-song score array. Every song
+        is counted once per gram, with the weight of its closest matching variant
+        '''
+        assert(len(gram) == self.n), "SONGINDEX, scoreGram gram length is not n!"
+        key = self._keys(gram)[0]
+        variants = key + self._errorKeys
+        lo = np.searchsorted(self.keys, variants)
+        found = (lo < len(self.keys)) & (self.keys[np.minimum(lo, len(self.keys) - 1)] == variants)
+        songs = []
+        weights = []
+        for j in np.nonzero(found)[0]:
+            k = lo[j]
+            posting = self.postings[self.offsets[k]:self.offsets[k+1]]
+            songs.append(posting)
+            weights.append(np.full(len(posting), self._errorWeight[j] * self.idf[k]))
+        if not songs:
+            return
+        songs = np.concatenate(songs)
+        weights = np.concatenate(weights)
+        best = np.zeros(len(scores))
+        np.maximum.at(best, songs, weights)
+        scores += best
+
+    def top(self, scores, k):
+        '''
+        return the ids of the k best scoring songs with a positive score, best first
+        '''
+        k = min(k, len(scores))
+        ids = np.argpartition(-scores, k - 1)[:k]
+        ids = ids[scores[ids] > 0]
+        return ids[np.argsort(-scores[ids], kind='stable')]
+
+class SongsMatchIndexed(_Posterior):
+    '''
+    SongsMatchNew restricted to the candidates proposed by an IntervalIndex.
+    DP matchers are only created for the top ranked songs; a song promoted later
+    is caught up on the notes sung so far. The posterior covers every song with
+    an upper bound on its DP cost where it has no matcher: a song dropped from
+    the candidates keeps its last cost plus note**2 + beta per note since, the
+    cost of matching those notes as duplicates, and a song never promoted
+    costs that for every note plus dropping its first interval, which is how
+    the cheapest alignment that skips every note reaches the song
+    '''
+    def __init__(self, dic, timedic={}, ncandidates=50, n=3, index=None, rhythmWeight=None):
+        self.dic = dic
+        self.timedic = timedic
+        self.index = index if index is not None else IntervalIndex(dic, n)
+        self.ncandidates = ncandidates
+        self.rhythmWeight = rhythmWeight
+        self._SONGNOTINDBSTR = 'Others'
+        self.songNames = self.index.songNames
+        self.songIndex = {name: j for j, name in enumerate(self.songNames)}
+        nsong = len(self.songNames)
+        self._initPosterior(nsong)
+        self.gamma = 1 # dropout cost of SongMatchNew
+        self._firstDrop = np.array([float(dic[name][0]) ** 2 + self.gamma for name in self.songNames])
+        self.cost = self._firstDrop.copy()
+        self.probDic = NameView(self.songIndex, self.prob, self._SONGNOTINDBSTR)
+        self.newprobDic = NameView(self.songIndex, self.newprob, self._SONGNOTINDBSTR)
+        self.avgWeight = 0.5
+        self.notDBCost = 3
+        self.beta = 5 # gap cost of SongMatchNew
+        self.songMatchDic = {}
+        self.t = []
+        self.ratios = [] # sung onset ratio of every note of t, or None
+        self.scores = np.zeros(nsong)
+        self.promoted = 0
+        self._counter = 0
+
+    def reset(self):
+        '''
+        start matching from scratch, as a newly built SongsMatchIndexed
+        '''
+        self.songMatchDic = {}
+        self.t = []
+        self.ratios = []
+        self.scores.fill(0)
+        self.cost[:] = self._firstDrop
+        self._counter = 0
+        self._resetPosterior()
+
+    def _applyReset(self):
+        # reset takes effect at once
+        pass
+
+    def _promote(self, name, upto):
+        # a matcher for name caught up on the first upto notes
+        if name not in self.timedic:
+            matcher = SongMatchNew(name, self.dic[name], rhythmWeight=self.rhythmWeight)
+        else:
+            matcher = SongMatchNew(name, self.dic[name], self.timedic[name], rhythmWeight=self.rhythmWeight)
+        if upto > 0:
+            matcher.addNotes(self.t[:upto], self.ratios[:upto])
+        self.songMatchDic[name] = matcher
+        self.promoted += 1
+
+    def _updateCandidates(self):
+        n = self.index.n
+        if len(self.t) < n:
+            return
+        self.index.scoreGram(self.t[-n:], self.scores)
+        candidates = [self.index.songNames[i] for i in self.index.top(self.scores, self.ncandidates)]
+        for name in candidates:
+            if name not in self.songMatchDic:
+                self._promote(name, len(self.t) - 1)
+        # drop songs that left the candidate list, their cost goes on growing
+        # from where it is
+        keep = set(candidates)
+        for name in list(self.songMatchDic):
+            if name not in keep:
+                del self.songMatchDic[name]
+
+    def addNote(self, note, ratio=None):
+        self.t += note
+        self.ratios.append(ratio)
+        self._counter += 1
+        self._updateCandidates()
+        self.cost += note[0] ** 2 + self.beta
+        cost = {}
+        for name, matcher in self.songMatchDic.items():
+            cost[name] = matcher.addNote(note, ratio)
+            self.cost[self.songIndex[name]] = cost[name]
+        self._updatePosterior(self.cost)
+        return cost
+
+    def addNotes(self, notes, ratios=None):
+        # return the match value for the last note
+        assert(len(notes) > 0), "SONGSMATCHINDEXED, addNotes argument length is 0!"
+        if ratios is None:
+            ratios = [None] * len(notes)
+        cost = {}
+        for j, ratio in zip(notes, ratios):
+            cost = self.addNote([j], ratio)
+        return cost
+
+    def getProbDic(self):
+        '''
+        return the dictionary of probability, a read-only view of self.prob
+        '''
+        return self.probDic
+
+    def getKeyTempo(self, songname, sfkey, tfkey, ttime):
+        assert(songname in self.songIndex), "SONGSMATCHINDEXED, getKeyTempo invalid song name"
+        if songname not in self.songMatchDic:
+            # best can be a song without a matcher
+            self._promote(songname, len(self.t))
+        return self.songMatchDic[songname].getKeyTempo(sfkey, tfkey, ttime)
+
+
+def syntheticCatalog(nsong, minlen=40, maxlen=150, seed=0):
+    '''
+    random interval melodies with roughly the step/leap mix of the musicbank songs
+    '''
+    rng = np.random.RandomState(seed)
+    steps = np.array([0, 0, 0, 1, -1, 2, -2, 2, -2, 3, -3, 4, -4, 5, -5, 7, -7])
+    dic = {}
+    for i in range(nsong):
+        dic['song%d' % i] = steps[rng.randint(len(steps), size=rng.randint(minlen, maxlen + 1))].tolist()
+    return dic
+
+def noisyQuery(s, length, rng, perr=0.1):
+    '''
+    the first length intervals of s with insertions, deletions and +-1 errors
+    '''
+    q = []
+    for x in s[:length]:
+        r = rng.rand()
+        if r < perr/3:
+            continue # deletion
+        if r < 2*perr/3:
+            q.append(int(x) + rng.choice([-1, 1]))
+        else:
+            q.append(int(x))
+        if rng.rand() < perr/3:
+            q.append(int(rng.randint(-3, 4))) # insertion
+    return q
+
+def noisyPerformance(s, stime, length, rng, perr=0.1, jitter=0.15):
+    '''
+    (intervals, durations) of a singer performing the first length notes of s
+    at a random tempo, with the errors of noisyQuery and timing jitter.
+    durations holds the [t_start, t_end] of every sung note, one more than the
+    intervals
+    '''
+    pitches = np.concatenate(([0], np.cumsum(s[:length])))
+    ioi = np.diff(np.concatenate(([0.0], stime[:length + 1])))
+    tempo = rng.uniform(0.7, 1.4)
+    sung = []
+    iois = []
+    for k, (p, d) in enumerate(zip(pitches, ioi)):
+        r = rng.rand()
+        if k > 0 and r < perr/3:
+            iois[-1] += d # deletion, the previous note is held on
+            continue
+        if r < 2*perr/3:
+            p += rng.choice([-1, 1])
+        if rng.rand() < perr/3:
+            # insertion, a short wrong note splits this one
+            sung += [p, p + rng.randint(-3, 4)]
+            iois += [d/2, d/2]
+        else:
+            sung.append(p)
+            iois.append(d)
+    iois = np.array(iois) * tempo * np.exp(rng.normal(0, jitter, len(iois)))
+    starts = np.concatenate(([0.0], np.cumsum(iois)[:-1]))
+    durations = [[float(a), float(a + 0.9*b)] for a, b in zip(starts, iois)]
+    return [int(x) for x in np.diff(sung)], durations
+
+if __name__ == "__main__":
+    import time
+    from songmatch import SongsMatchBatch
+    rng = np.random.RandomState(1)
+    nquery = 20
+    qlen = 12
+    for nsong in (10000, 100000):
+        dic = syntheticCatalog(nsong)
+        t0 = time.perf_counter()
+        index = IntervalIndex(dic)
+        print("%d songs: index built in %.1fs" % (nsong, time.perf_counter() - t0))
+        names = list(dic)
+        recall = 0
+        hits = 0
+        fullhits = 0
+        tindexed = []
+        tfull = []
+        for k in range(nquery):
+            truth = names[rng.randint(nsong)]
+            q = noisyQuery(dic[truth], qlen, rng)
+            full = SongsMatchBatch(dic)
+            indexed = SongsMatchIndexed(dic, index=index)
+            for x in q:
+                t0 = time.perf_counter()
+                indexed.addNote([x])
+                t1 = time.perf_counter()
+                full.addNote([x])
+                t2 = time.perf_counter()
+                tindexed.append(t1 - t0)
+                tfull.append(t2 - t1)
+            recall += truth in indexed.songMatchDic
+            hits += indexed.best()[0] == truth
+            fullhits += full.best()[0] == truth
+        print("  recall@%d of the sung song: %.2f" % (indexed.ncandidates, recall/nquery))
+        print("  sung song identified, indexed: %.2f, full scan: %.2f" % (hits/nquery, fullhits/nquery))
+        print("  per-note latency, indexed: median %.2fms, p95 %.2fms" % (1e3*np.median(tindexed), 1e3*np.percentile(tindexed, 95)))
+        print("  per-note latency, full scan: median %.2fms, p95 %.2fms" % (1e3*np.median(tfull), 1e3*np.percentile(tfull, 95)))
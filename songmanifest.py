@@ -0,0 +1,158 @@
+"""
+Song discovery: the songs of a music directory and the files each of them
+has, found by scanning the directory once and kept in a manifest file
+(manifest.json in the directory) with the size and mtime of every file.
+Later startups only stat the directory and the recorded files to check the
+manifest is still current, and scan again when it is not.
+
+    allSongNames = discoverSongs(required=('melody', 'timestamps', 'wav'))
+
+lists the songs having every required file and reports the others, with
+what they are missing, before anything is loaded.
+"""
+import json
+import os
+from song import SONG_PATH
+
+# the files of a song, name + suffix, longest suffixes first so that
+# name_stripped.mid is not taken for a song called name_stripped
+ARTIFACTS = [
+    ('melody_mid', '_stripped.mid'),
+    ('melody', '_stripped.txt'),
+    ('timestamps', '_timestamps.txt'),
+    ('mid', '.mid'),
+    ('wav', '.wav'),
+]
+MANIFEST_NAME = 'manifest.json'
+_VERSION = 1
+
+def _stat(filename):
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns]
+
+def scanSongs(songPath=SONG_PATH):
+    '''
+    {song name: {artifact: [size, mtime_ns]}} of every song file in songPath
+    '''
+    songs = {}
+    for filename in sorted(os.listdir(songPath)):
+        for artifact, suffix in ARTIFACTS:
+            if filename.endswith(suffix) and len(filename) > len(suffix):
+                name = filename[:-len(suffix)]
+                songs.setdefault(name, {})[artifact] = _stat(os.path.join(songPath, filename))
+                break
+    return songs
+
+class SongManifest(object):
+    """
+    The songs of a music directory and their files, see loadManifest
+    """
+    def __init__(self, songPath, songs):
+        self.songPath = songPath
+        self.songs = songs
+
+    def path(self, songname, artifact):
+        return os.path.join(self.songPath, songname + dict(ARTIFACTS)[artifact])
+
+    def has(self, songname, artifact):
+        return artifact in self.songs.get(songname, {})
+
+    def songNames(self, required=('melody',)):
+        '''
+        sorted names of the songs having every required artifact
+        '''
+        return sorted(name for name, files in self.songs.items() if all(a in files for a in required))
+
+    def missing(self, required=('melody',), names=None):
+        '''
+        {song name: [missing artifacts]} of the songs (names, every song by
+        default) lacking some of the required artifacts
+        '''
+        names = sorted(self.songs) if names is None else names
+        missing = {}
+        for name in names:
+            lacking = [a for a in required if not self.has(name, a)]
+            if lacking:
+                missing[name] = lacking
+        return missing
+
+    def isCurrent(self, dirMtime):
+        '''
+        True when the directory and every recorded file are unchanged
+        '''
+        try:
+            if os.stat(self.songPath).st_mtime_ns != dirMtime:
+                return False
+            for name, files in self.songs.items():
+                for artifact, stat in files.items():
+                    if _stat(self.path(name, artifact)) != stat:
+                        return False
+        except OSError:
+            return False
+        return True
+
+def _manifestFile(songPath, filename):
+    return os.path.join(songPath, MANIFEST_NAME) if filename is None else filename
+
+def saveManifest(manifest, filename=None):
+    filename = _manifestFile(manifest.songPath, filename)
+    record = {'version': _VERSION, 'songs': manifest.songs}
+    for attempt in range(2):
+        # creating the file changes the directory mtime, the second write
+        # goes to the existing file and records the final one
+        record['dir_mtime_ns'] = os.stat(manifest.songPath).st_mtime_ns
+        with open(filename, 'w') as file:
+            json.dump(record, file, indent=1, sort_keys=True)
+
+def loadManifest(songPath=SONG_PATH, filename=None, rescan=False):
+    '''
+    the SongManifest of songPath, read from its manifest file when that is
+    still current, otherwise (or with rescan) scanned again and saved
+    '''
+    filename = _manifestFile(songPath, filename)
+    if not rescan and os.path.exists(filename):
+        try:
+            with open(filename, 'r') as file:
+                record = json.load(file)
+        except ValueError:
+            record = {}
+        if record.get('version') == _VERSION:
+            manifest = SongManifest(songPath, record['songs'])
+            if manifest.isCurrent(record['dir_mtime_ns']):
+                return manifest
+    manifest = SongManifest(songPath, scanSongs(songPath))
+    saveManifest(manifest, filename)
+    return manifest
+
+def discoverSongs(required=('melody', 'timestamps'), songPath=SONG_PATH, names=None, report=True):
+    '''
+    names of the songs of songPath (or of names) having every required
+    artifact. The songs left out are printed with their missing artifacts
+    when report is set
+    '''
+    manifest = loadManifest(songPath)
+    if names is None:
+        found = manifest.songNames(required)
+        missing = manifest.missing(required)
+    else:
+        missing = manifest.missing(required, names)
+        found = [name for name in names if name not in missing]
+    if report:
+        for name, lacking in sorted(missing.items()):
+            print("SONGMANIFEST, %s left out, missing %s" % (name, ', '.join(lacking)))
+    return found
+
+if __name__ == "__main__":
+    import sys
+    import time
+    songPath = sys.argv[1] if len(sys.argv) > 1 else SONG_PATH
+    t0 = time.perf_counter()
+    manifest = loadManifest(songPath, rescan=True)
+    tscan = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    manifest = loadManifest(songPath)
+    tload = time.perf_counter() - t0
+    print("%d songs in %s, scanned in %.2fms, manifest checked in %.2fms" % (len(manifest.songs), songPath,
+          1e3*tscan, 1e3*tload))
+    for name in sorted(manifest.songs):
+        print("  %-28s %s" % (name, ', '.join(a for a, suffix in ARTIFACTS if manifest.has(name, a))))
@@ -1,8 +1,90 @@
 import numpy as np
 import math
+import heapq
+from bisect import bisect_left, insort
+from collections import deque
+from collections.abc import Mapping
 
 DEBUG = 0
 
+# per byte of the vertical delta bit-vectors (VP, VN), bit 0 being the top row:
+# the net score change over the byte and the lowest running score inside it
+_bits = (np.arange(256)[:,None] >> np.arange(8)) & 1
+_deltas = np.cumsum(_bits[:,None,:] - _bits[None,:,:], axis=2)
+_BYTENET = _deltas[:,:,-1].astype(np.int32)
+_BYTEMIN = _deltas.min(axis=2).astype(np.int32)
+del _bits, _deltas
+
+class BitParallelMatch:
+    '''
+    Bit-parallel (Myers/Hyyrö) unit-cost edit distance of a growing query t
+    against a fixed song s. One column of the (len(s)+1) x (len(t)+1) distance
+    matrix is kept as the vertical +1/-1 delta bit-vectors of all song positions,
+    so adding a note costs a handful of big integer operations instead of a loop
+    over the song. Works for any hashable alphabet (intervals or U/D/S)
+    '''
+    def __init__(self, s):
+        self.m = len(s)
+        self._mask = (1 << self.m) - 1
+        # position masks of every symbol of the song
+        self._peq = {}
+        for i, c in enumerate(s):
+            self._peq[c] = self._peq.get(c, 0) | (1 << i)
+        self._nbytes = (self.m + 7)//8
+        self.reset()
+
+    def reset(self):
+        # d[i,0] = i: every vertical delta is +1
+        self.vp = self._mask
+        self.vn = 0
+        self.n = 0
+        self.score = self.m # d[m,n]
+
+    def addNote(self, c):
+        if self.m == 0:
+            # no song rows, d[0,n] = n
+            self.n += 1
+            self.score = self.n
+            return self.score
+        eq = self._peq.get(c, 0)
+        vp = self.vp
+        vn = self.vn
+        xv = eq | vn
+        xh = ((((eq & vp) + vp) & self._mask) ^ vp) | eq
+        hp = vn | (~(xh | vp) & self._mask)
+        hn = vp & xh
+        if hp >> (self.m - 1) & 1:
+            self.score += 1
+        elif hn >> (self.m - 1) & 1:
+            self.score -= 1
+        # d[0,n] = n, so a +1 horizontal delta enters at the top row
+        hp = ((hp << 1) | 1) & self._mask
+        hn = (hn << 1) & self._mask
+        self.vp = hn | (~(xv | hp) & self._mask)
+        self.vn = hp & xv
+        self.n += 1
+        return self.score
+
+    def getScore(self):
+        '''
+        return d[len(s), len(t)], the global edit distance
+        '''
+        return self.score
+
+    def getMatchVal(self):
+        '''
+        return min over i >= 1 of d[i, len(t)], the best matching end in s
+        '''
+        if self.m == 0:
+            return self.n + 1
+        vp = np.frombuffer(self.vp.to_bytes(self._nbytes, 'little'), dtype=np.uint8)
+        vn = np.frombuffer(self.vn.to_bytes(self._nbytes, 'little'), dtype=np.uint8)
+        net = _BYTENET[vp, vn]
+        # score at the top of every byte plus the lowest point inside it; the zero
+        # padding bits of the last byte only repeat d[m,n]
+        before = np.cumsum(net) - net
+        return self.n + int((before + _BYTEMIN[vp, vn]).min())
+
 def LevenshteinMatrix(s,t):
     '''
     (list,list) -> matrix or (str, str) -> matrix
@@ -34,10 +116,12 @@ def LevenshteinDistance(s,t):
     '''
     (list,list) -> int or (str, str) -> int
     Calculate the distance between two strings s and t
-    Matrix implementation is used (DP)
+    Bit-parallel implementation is used, see LevenshteinMatrix for the DP
     '''
-    d = LevenshteinMatrix(s,t)
-    return d[len(s),len(t)]
+    bp = BitParallelMatch(s)
+    for c in t:
+        bp.addNote(c)
+    return float(bp.getScore())
 
 def getMatchMatrix(s,t):
     '''
@@ -60,54 +144,596 @@ def getMatchVal(s,t):
     (list,list) -> int or (str, str) -> int
     return the ending index of the best matching
     '''
-    d = getMatchMatrix(s,t)
-    nrow = len(s) + 1
-    colind = len(t)
-    minval = len(t)+1
-    index = 0
-    for i in range(1, nrow):
-        if (d[i,colind] < minval):
-            index = i
-            minval = d[i,colind]
-    return minval
+    assert(len(s) > len(t)), "SONGMATCH, getMatchVal: first string must be longer than the second string!"
+    bp = BitParallelMatch(s)
+    for c in t:
+        bp.addNote(c)
+    return float(bp.getMatchVal())
+
+def convert_durations(ds):
+    '''
+    ([[t_start, t_end], ...]) -> list
+    note end times relative to the first note start, the last (still open) note
+    is left out
+    '''
+    start_time = ds[0][0]
+    durations = []
+    for i,d in enumerate(ds):
+        if i+1 < len(ds):
+            durations.append(d[1]-start_time)
+    return durations
+
+def keyTempo(s, stime, t, diffmat, sfkey, tfkey, ttime):
+    '''
+    (list,list,list,array,num,num,list) -> [keydiff, temporatio, startpt]
+    Estimate key offset, tempo ratio and playback position of song s from the
+    sung intervals t and their alignment diffmat (rows of [song index, note count])
+    '''
+    diffmat = np.asarray(diffmat).reshape(-1, 2)
+    sidx = diffmat[:,0]
+    tidx = diffmat[:,1]
+    n = len(diffmat)
+    # reconstruct full key list, cumsum adds in the same order as a running total
+    tkeyl = np.cumsum(np.concatenate(([tfkey], np.asarray(t[:n]))))
+    skeyl = np.cumsum(np.concatenate(([sfkey], np.asarray(s))))
+    # stime, ttime : tempo list
+    # skeyl, tkeyl : key list
+    if DEBUG:
+        print("skeyl and tkeyl vals:")
+        print(skeyl)
+        print(tkeyl)
+        print("DIFFMAT: " + str(diffmat.tolist()))
+        print("stime and ttime:")
+        print(stime)
+        print(ttime)
+    # key average algorithm:
+    keydifftotal = np.cumsum(np.concatenate(([tfkey - sfkey], tkeyl[tidx] - skeyl[sidx])))[-1]
+    keydiff = float(keydifftotal/(n+1))
+
+    # tempo crude average algorithm:
+    # temporatio = (ttime[diffmat[-1][1]] - ttime[0])/(stime[diffmat[-1][0]] - stime[0])
+    # temporatio = (stime[diffmat[-1][0]])/(ttime[diffmat[-1][1]])
+    stime = np.asarray(stime, dtype=float)
+    ttime = np.asarray(ttime, dtype=float)
+    tempolist = np.empty(n + 1)
+    tempolist[:n-1] = np.diff(stime[sidx])/np.diff(ttime[tidx])
+    tempolist[n-1:] = stime[sidx[-1]-sidx[0] + 1]/ttime[tidx[-1]]
+    tempolist.sort()
+    k = len(tempolist)//2
+    # unscented trasform
+    temporatio = float(0.2 * tempolist[k-1] + 0.6 * tempolist[k] + 0.2 * tempolist[k+1])
+
+    # where to play
+    startpt = float(stime[sidx[-1]])
+    return [keydiff, temporatio, startpt]
+
+def _takeDeleted(deleted, x):
+    # True if x is pending deletion, which is then used up
+    count = deleted.get(x)
+    if not count:
+        return False
+    if count == 1:
+        del deleted[x]
+    else:
+        deleted[x] = count - 1
+    return True
+
+class _MiddleRun:
+    '''
+    Multiset of numbers that keeps a short sorted run of consecutive order
+    statistics in a list, with a max-heap of the values below it and a min-heap
+    of the values above it. Removals from the heaps are lazy
+    '''
+    def __init__(self):
+        self._low = [] # negated
+        self._mid = []
+        self._high = []
+        self._nlow = 0
+        self._nhigh = 0
+        self._lowDeleted = {}
+        self._highDeleted = {}
+
+    def __len__(self):
+        return self._nlow + len(self._mid) + self._nhigh
+
+    def _lowMax(self):
+        while _takeDeleted(self._lowDeleted, -self._low[0]):
+            heapq.heappop(self._low)
+        return -self._low[0]
+
+    def _highMin(self):
+        while _takeDeleted(self._highDeleted, self._high[0]):
+            heapq.heappop(self._high)
+        return self._high[0]
+
+    def _compact(self):
+        # rebuild a heap from its live values once the deleted ones buried
+        # below the top outnumber them
+        if len(self._low) > 2*self._nlow + 8:
+            self._low = [x for x in self._low if not _takeDeleted(self._lowDeleted, -x)]
+            heapq.heapify(self._low)
+        if len(self._high) > 2*self._nhigh + 8:
+            self._high = [x for x in self._high if not _takeDeleted(self._highDeleted, x)]
+            heapq.heapify(self._high)
+
+    def _popLow(self):
+        x = self._lowMax()
+        heapq.heappop(self._low)
+        self._nlow -= 1
+        return x
+
+    def _popHigh(self):
+        x = self._highMin()
+        heapq.heappop(self._high)
+        self._nhigh -= 1
+        return x
+
+    def _pushLow(self, x):
+        heapq.heappush(self._low, -x)
+        self._nlow += 1
+
+    def _pushHigh(self, x):
+        heapq.heappush(self._high, x)
+        self._nhigh += 1
+
+    def insert(self, x):
+        if self._nlow and x < self._lowMax():
+            self._pushLow(x)
+        elif self._nhigh and x > self._highMin():
+            self._pushHigh(x)
+        else:
+            insort(self._mid, x)
+
+    def remove(self, x):
+        i = bisect_left(self._mid, x)
+        if i < len(self._mid) and self._mid[i] == x:
+            del self._mid[i]
+        elif self._nlow and x <= self._lowMax():
+            self._lowDeleted[x] = self._lowDeleted.get(x, 0) + 1
+            self._nlow -= 1
+        else:
+            self._highDeleted[x] = self._highDeleted.get(x, 0) + 1
+            self._nhigh -= 1
+        self._compact()
+
+    def run(self, lo, size):
+        '''
+        return the sorted values at positions lo to lo+size-1, or up to the last
+        '''
+        size = min(size, len(self) - lo)
+        while self._nlow > lo:
+            self._mid.insert(0, self._popLow())
+        while self._nlow < lo:
+            self._pushLow(self._mid.pop(0) if self._mid else self._popHigh())
+        while len(self._mid) > size:
+            self._pushHigh(self._mid.pop())
+        while len(self._mid) < size:
+            self._mid.append(self._popHigh())
+        return self._mid
+
+class KeyTempoTracker:
+    '''
+    Streaming version of keyTempo for one song: the sung notes and their
+    alignment rows are added one at a time and the estimate is kept up to date
+    with running key sums and the middle order statistics of the tempo ratios,
+    in O(log n) per note
+    '''
+    def __init__(self, s, stime, sfkey, tfkey, duration, window=None):
+        # song side, once per song
+        self.skeyl = np.cumsum(np.concatenate(([sfkey], np.asarray(s))))
+        self.stime = np.asarray(stime, dtype=float)
+        self.window = window
+        # [t_start, t_end] of the first sung note, times are taken from its start
+        self._start = duration[0]
+        # per kept note: sung key, start and end time relative to self._start;
+        # per kept interval: alignment row, key difference and tempo ratio to
+        # the previous interval
+        self._tkey = deque([tfkey])
+        self._tstart = deque([0.0])
+        self._tend = deque([duration[1] - self._start])
+        self._sidx = deque()
+        self._keyterm = deque()
+        self._ratio = deque()
+        self._keysum = tfkey - sfkey
+        self._ratios = _MiddleRun()
+
+    def addNote(self, interval, sidx, duration):
+        '''
+        (num, int, list) -> None
+        add one sung interval, the song row it is aligned to and the
+        [t_start, t_end] of the note it leads to
+        '''
+        tkey = self._tkey[-1] + interval
+        tend = duration[1] - self._start
+        keyterm = tkey - self.skeyl[sidx]
+        self._keysum += keyterm
+        if self._sidx:
+            ratio = (self.stime[sidx] - self.stime[self._sidx[-1]])/np.float64(tend - self._tend[-1])
+            self._ratio.append(ratio)
+            self._ratios.insert(ratio)
+        self._tkey.append(tkey)
+        self._tstart.append(duration[0] - self._start)
+        self._tend.append(tend)
+        self._sidx.append(sidx)
+        self._keyterm.append(keyterm)
+        if self.window is not None:
+            self.trimHistory(self.window)
+        # keep the sorted run around the middle, so it stays short
+        self._middle()
+
+    def trimHistory(self, nkeep):
+        '''
+        keep only the last nkeep intervals, as SongMatchNew.trimHistory
+        '''
+        assert(nkeep >= 1), "KEYTEMPOTRACKER, trimHistory must keep at least one note"
+        while len(self._sidx) > nkeep:
+            # the key sum starts from the first kept note instead
+            tkey = self._tkey.popleft()
+            self._keysum += self._tkey[0] - tkey - self._keyterm.popleft()
+            self._tstart.popleft()
+            self._tend.popleft()
+            self._sidx.popleft()
+            self._ratios.remove(self._ratio.popleft())
+        self._middle()
+
+    def _middle(self):
+        # the tempo list is every ratio between consecutive intervals plus
+        # twice the overall ratio. The three entries around its middle can only
+        # come from the ratios at positions k-3 to k+1
+        k = (len(self._sidx) + 1)//2
+        lo = max(k - 3, 0)
+        return k, lo, self._ratios.run(lo, k + 2 - lo)
+
+    def getKeyTempo(self):
+        '''
+        return [keydiff, temporatio, startpt], as keyTempo on the kept notes
+        '''
+        n = len(self._sidx)
+        assert(n >= 2), "KEYTEMPOTRACKER, need at least two sung intervals"
+        keydiff = float(self._keysum/(n+1))
+        k, lo, middle = self._middle()
+        last = self.stime[self._sidx[-1] - self._sidx[0] + 1]/np.float64(self._tend[-1] - self._tstart[0])
+        below = lo + bisect_left(middle, last)
+        def tempo(j):
+            if j < below:
+                return middle[j - lo]
+            if j < below + 2:
+                return last
+            return middle[j - 2 - lo]
+        # unscented trasform
+        temporatio = float(0.2 * tempo(k-1) + 0.6 * tempo(k) + 0.2 * tempo(k+1))
+        startpt = float(self.stime[self._sidx[-1]])
+        return [keydiff, temporatio, startpt]
+
+def compactIntervals(s):
+    '''
+    (list) -> array
+    the smallest integer array holding the intervals of s, float64 if they are
+    not whole semitones
+    '''
+    arr = np.asarray(s, dtype=float)
+    if not np.array_equal(arr, np.round(arr)):
+        return arr
+    if len(arr) == 0 or np.abs(arr).max() <= 127:
+        return arr.astype(np.int8)
+    if np.abs(arr).max() <= 32767:
+        return arr.astype(np.int16)
+    return arr
+
+def onsetRatios(onsets):
+    '''
+    (list) -> array
+    log2 of the ratio of every inter-onset time to the one before it, for
+    the note onset times onsets (the last one being where the next note would
+    start). Tempo invariant, entry k belongs to the interval from note k to
+    note k+1
+    '''
+    ioi = np.maximum(np.diff(np.asarray(onsets, dtype=float)), 1e-3)
+    return np.log2(ioi[1:]/ioi[:-1])
+
+def songOnsetRatios(s, stime):
+    '''
+    onsetRatios of a song from its note end times stime, None when stime does
+    not hold one time per note
+    '''
+    if len(stime) != len(s) + 1:
+        return None
+    return onsetRatios(np.concatenate(([0.0], np.asarray(stime, dtype=float))))
+
+def _addRhythmCost(cost, ratios, ratio, weight):
+    # rhythm term of the transposition step: weight * (ratio difference)^2,
+    # saturating at weight for a tempo change of a factor 2 or more
+    tmp = _scratchBuffer('rhythm', len(ratios), np.float64)
+    np.subtract(ratios, ratio, out=tmp)
+    np.square(tmp, out=tmp)
+    np.minimum(tmp, 1.0, out=tmp)
+    tmp *= weight
+    np.rint(tmp, out=tmp)
+    np.add(cost, tmp, out=cost, casting='unsafe')
+
+# scratch columns shared by every SongMatchNew of the process, they only hold
+# intermediate values during one column update
+_scratch = {}
+
+def _scratchBuffer(key, n, dtype):
+    buf = _scratch.get((key, dtype))
+    if buf is None or len(buf) < n:
+        buf = np.empty(max(n, 256), dtype=dtype)
+        _scratch[(key, dtype)] = buf
+    return buf[:n]
 
 class SongMatchNew:
-    def __init__(self, songname = '', s=[], stime=[]):
-        self.s = s # song DB
+    __slots__ = ('s', 'stime', 'd', 'songname', 'alpha', 'beta', 'gamma', 'margin',
+                 'rowsUpdated', '_tbuf', '_trace', '_ntrace', '_minval', '_minindex',
+                 '_counter', '_activeColumn', '_inactiveColumn', '_modifySongFlag',
+                 '_initizalized', '_cumdrop', '_bands', '_inf', 'window', '_first',
+                 '_dropped', '_droppedSum', 'rhythmWeight', '_ratios', '_fractional')
+
+    def __init__(self, songname = '', s=[], stime=[], margin=None, window=None, rhythmWeight=None):
+        self.s = compactIntervals(s) # song DB
         self.stime = stime
-        self.t = [] # matching word
         self.d = []
         self.songname = songname
         self.alpha = 0 # transpose fix cost
         self.beta = 5 # duplicate fix cost
         self.gamma = 1 # dropout fix cost
-        self.diffmat = []
+        # pruned mode: only rows within margin of the column minimum are updated
+        self.margin = margin
+        self.rowsUpdated = 0
+        # sliding window mode: t and diffmat only keep the last window notes
+        assert(window is None or window >= 1), "SONGMATCH, window must hold at least one note"
+        self.window = window
+        # rhythm mode: a transposition also costs the mismatch of the sung and
+        # song inter-onset ratios, see addNote. None matches on pitch alone
+        self.rhythmWeight = rhythmWeight
+        self._ratios = None
+        # matching word and alignment trace, grown by doubling. Trimmed notes
+        # are left in front of _first until the space is reused. The notes
+        # have the dtype of the columns
+        self._fractional = False # a fractional note was sung
+        self._tbuf = np.zeros(16, dtype=self._columnDtype())
+        self._trace = np.zeros([16, 2], dtype=np.int32)
+        self._ntrace = 0
+        self._first = 0
+        self._dropped = 0 # number of notes trimmed
+        self._droppedSum = 0 # sum of the intervals trimmed
+        self._minval = 10000
+        self._minindex = 0
         self._counter = 0
         self._activeColumn = 0
         self._inactiveColumn = 1
         self._modifySongFlag = True
         self._initizalized = False
 
+    @property
+    def t(self):
+        '''
+        the notes matched so far, the last window notes in sliding window mode
+        '''
+        return self._tbuf[self._first:self._first + self._counter - self._dropped]
+
+    @property
+    def diffmat(self):
+        '''
+        the [song index, note count] rows of the best alignment end after every
+        note, aligned with t
+        '''
+        return self._trace[self._first:self._ntrace]
+
+    def _reserve(self):
+        # room for one more note at the end of the buffers: move the kept notes
+        # to the front once the trimmed ones fill half of them, double otherwise
+        n = self._counter - self._dropped
+        if self._first >= len(self._tbuf) // 2:
+            self._tbuf[:n] = self._tbuf[self._first:self._first + n]
+            ntrace = self._ntrace - self._first
+            self._trace[:ntrace] = self._trace[self._first:self._ntrace]
+            self._ntrace = ntrace
+            self._first = 0
+        else:
+            self._tbuf = np.concatenate((self._tbuf, np.zeros_like(self._tbuf)))
+        if len(self._trace) < len(self._tbuf):
+            self._trace = np.concatenate((self._trace, np.zeros_like(self._trace)))
+
+    def trimHistory(self, nkeep):
+        '''
+        keep only the last nkeep notes in t and diffmat. The DP columns already
+        account for the notes dropped, getKeyTempo works on the kept ones
+        '''
+        assert(nkeep >= 1), "SONGMATCH, trimHistory must keep at least one note"
+        drop = self._counter - self._dropped - nkeep
+        if drop <= 0:
+            return
+        self._droppedSum += self._tbuf[self._first:self._first + drop].sum().item()
+        self._first += drop
+        self._dropped += drop
+
     def getstime(self):
         return self.stime
 
     def modifySong(self,s):
         assert(self._modifySongFlag), "SONGMATCH, cannot modify song DB！"
-        self.s = s
+        self.s = compactIntervals(s)
+        self._tbuf = np.zeros(len(self._tbuf), dtype=self._columnDtype())
 
-    def addNote(self,note):
-        # note is a single character string
+    def _columnDtype(self):
+        # costs are whole numbers for whole semitone intervals and fit int32
+        return np.float64 if self.s.dtype == np.float64 or self._fractional else np.int32
+
+    def _toFloat(self):
+        # a fractional note makes the costs fractional, go on in float64
+        self._fractional = True
+        self._tbuf = self._tbuf.astype(np.float64)
+        if self._initizalized:
+            outside = self.d >= self._inf
+            self.d = self.d.astype(np.float64)
+            self.d[outside] = np.inf
+            self._cumdrop = self._cumdrop.astype(np.float64)
+            self._inf = np.inf
+
+    def _initColumns(self):
+        # precompute the song-side terms once, the columns only depend on them
+        # and on the incoming note
+        nrow = len(self.s) + 1
+        dtype = self._columnDtype()
+        self._inf = np.inf if dtype == np.float64 else 2**30
+        dropcost = self.s.astype(dtype) ** 2 + self.gamma
+        # _cumdrop[i] is the cost of dropping the first i song intervals
+        self._cumdrop = np.zeros(nrow, dtype=dtype)
+        np.cumsum(dropcost, out=self._cumdrop[1:])
+        self.d = np.zeros([nrow, 2], dtype=dtype)
+        if self.rhythmWeight is not None:
+            self._ratios = songOnsetRatios(self.s, self.stime)
+        self._resetColumns()
+
+    def _resetColumns(self):
+        # initial column from the precomputed terms, in place
+        self._activeColumn = 0
+        self._inactiveColumn = 1
+        self.d[:,0] = self._cumdrop
+        if self.margin is not None:
+            # rows outside the band of a column are kept at inf, except row 0
+            # which is cheap and always up to date
+            hi = self._extendBand(0, 1, self._cumdrop[1] + self.margin, self.d[:,0])
+            self.d[hi+1:,0] = self._inf
+            self.d[1:,1] = self._inf
+            self._bands = [(0, hi), (1, 0)]
+
+    def reset(self):
+        '''
+        forget the notes matched so far, keeping the precomputed song terms
+        '''
+        self._counter = 0
+        self._ntrace = 0
+        self._first = 0
+        self._dropped = 0
+        self._droppedSum = 0
+        self._minval = 10000
+        self._minindex = 0
+        self.rowsUpdated = 0
+        if self._initizalized:
+            self._resetColumns()
+
+    def snapshot(self):
+        '''
+        return a copy of the matching state, to be passed to restore
+        '''
+        bands = list(self._bands) if self.margin is not None and self._initizalized else None
+        columns = self.d.copy() if self._initizalized else None
+        return (self.t.copy(), self.diffmat.copy(), columns, bands, self._activeColumn,
+                self._minval, self._minindex, self.rowsUpdated, self._counter,
+                self._dropped, self._droppedSum)
+
+    def restore(self, state):
+        '''
+        go back to the matching state returned by snapshot
+        '''
+        (t, trace, columns, bands, active, minval, minindex, rowsUpdated, counter,
+         dropped, droppedSum) = state
+        self.reset()
+        if t.dtype == np.float64 and self._tbuf.dtype != np.float64:
+            self._toFloat()
+        if columns is not None:
+            if not self._initizalized:
+                self._initColumns()
+                self._initizalized = True
+                self._modifySongFlag = False
+            self.d[:] = columns
+            self._activeColumn = active
+            self._inactiveColumn = 1 - active
+            if bands is not None:
+                self._bands = list(bands)
+        if len(self._tbuf) < len(t):
+            self._tbuf = np.zeros(max(len(t), 16), dtype=self._tbuf.dtype)
+        if len(self._trace) < len(trace):
+            self._trace = np.zeros([max(len(trace), 16), 2], dtype=np.int32)
+        self._tbuf[:len(t)] = t
+        self._trace[:len(trace)] = trace
+        self._counter = counter
+        self._ntrace = len(trace)
+        self._dropped = dropped
+        self._droppedSum = droppedSum
+        self._minval = minval
+        self._minindex = minindex
+        self.rowsUpdated = rowsUpdated
+
+    def _extendBand(self, hi, last, bound, cur):
+        # below the band only the dropout chain from the last computed row is finite,
+        # and it grows monotonically: find where it crosses bound and fill it in
+        nrow = len(cur)
+        limit = bound - cur[hi] + self._cumdrop[hi]
+        ext = min(int(np.searchsorted(self._cumdrop, limit, 'right')) - 1, nrow - 1)
+        if ext > last:
+            cur[last+1:ext+1] = self._cumdrop[last+1:ext+1] - self._cumdrop[hi] + cur[hi]
+            return ext
+        return last
+
+    def _addNoteBand(self, prev, cur, note, ratio):
+        # same recurrence as addNote, restricted to the rows reachable from the
+        # band of the previous column
+        plo, phi = self._bands[self._inactiveColumn]
+        olo, ohi = self._bands[self._activeColumn]
+        nrow = len(cur)
+        lo = max(plo, 1)
+        hi = min(phi + 1, nrow - 1)
+        transpositionCost = _scratchBuffer('tmp', hi - lo + 1, cur.dtype)
+        np.subtract(self.s[lo-1:hi], note, out=transpositionCost, dtype=cur.dtype)
+        np.square(transpositionCost, out=transpositionCost)
+        transpositionCost += self.alpha
+        if ratio is not None:
+            _addRhythmCost(transpositionCost, self._ratios[lo-1:hi], ratio, self.rhythmWeight)
+        transpositionCost += prev[lo-1:hi]
+        duplicationCost = cur[lo:hi+1]
+        np.add(prev[lo:hi+1], note ** 2 + self.beta, out=duplicationCost)
+        np.minimum(duplicationCost, transpositionCost, out=duplicationCost)
+        # row 0 only feeds the chain while it is inside the band
+        start = 0 if plo == 0 else lo
+        scan = _scratchBuffer('scan', hi - start + 1, cur.dtype)
+        np.subtract(cur[start:hi+1], self._cumdrop[start:hi+1], out=scan)
+        np.minimum.accumulate(scan, out=scan)
+        np.add(scan, self._cumdrop[start:hi+1], out=cur[start:hi+1])
+        # rows past hi are above cur[hi] and row 0 is left out, so this is
+        # also the minimum of the new band
+        index = self._lastArgmin(cur, lo, hi)
+        bound = cur[index] + self.margin
+        ext = self._extendBand(hi, hi, bound, cur)
+        self.rowsUpdated += ext - start + 1
+        # new band: first to last computed row within the bound
+        inband = np.flatnonzero(cur[start:ext+1] <= bound)
+        nlo = start + int(inband[0])
+        nhi = start + int(inband[-1])
+        # clear everything else this column holds, including what is left of
+        # its band from two notes ago
+        cur[max(min(olo, start), 1):max(nlo, 1)] = self._inf
+        cur[nhi+1:max(ohi, ext)+1] = self._inf
+        self._bands[self._activeColumn] = (nlo, nhi)
+        self._locateMin(index)
+
+    def getBandSize(self):
+        '''
+        return the number of rows in the active band of the current column
+        '''
+        if self.margin is None or not self._initizalized:
+            return len(self.s) + 1
+        lo, hi = self._bands[self._activeColumn]
+        return hi - lo + 1
+
+    def addNote(self, note, ratio=None):
+        # note is a single character string. ratio is the onsetRatios entry of
+        # the sung interval, used in rhythm mode when the song has timestamps
         assert(len(note) == 1), "SONGMATCH, addNote argument length is not 1!"
-        self.t += note
+        end = self._first + self._counter - self._dropped
+        if end == len(self._tbuf):
+            self._reserve()
+            end = self._first + self._counter - self._dropped
+        self._tbuf[end] = note[0]
+        if self._tbuf[end] != note[0]:
+            self._toFloat()
+            self._tbuf[end] = note[0]
         self._counter += 1
-        nrow = len(self.s) + 1
         if (not self._initizalized):
-            assert(self.s), "SONGMATCH, song DB string uninitialized"
-            self.d = np.zeros([nrow, 2])
-            for j in range(1): # only the first c is initialized
-                self.d[0,j] = j
-            for i in range(1, nrow):
-                self.d[i,0] = self.d[i-1,0] + self.gamma + self.s[i-1]**2
+            assert(len(self.s)), "SONGMATCH, song DB string uninitialized"
+            self._initColumns()
             self._initizalized = True
             self._modifySongFlag = False
             self._activeColumn = 0
@@ -117,101 +743,125 @@ class SongMatchNew:
         tmp = self._activeColumn
         self._activeColumn = self._inactiveColumn
         self._inactiveColumn = tmp
+        prev = self.d[:,self._inactiveColumn]
+        cur = self.d[:,self._activeColumn]
+        note = self._tbuf[end].item()
+        if self._ratios is None:
+            ratio = None
         # initizalize the column value for the next iteration
-        self.d[0,self._activeColumn] = self.d[0,self._inactiveColumn] + self.beta + self.t[self._counter-1] ** 2
-        for i in range(1,nrow):
-            transpositionCost = self.d[i-1,self._inactiveColumn] + ((self.s[i-1] - self.t[self._counter-1]) ** 2 + self.alpha)
-            duplicationCost = self.d[i,self._inactiveColumn] + ((self.t[self._counter-1]) ** 2 + self.beta)
-            dropoutCost = self.d[i-1,self._activeColumn] + ((self.s[i-1]) ** 2 + self.gamma)
-            # if self._counter > 1:
-            #     duplicationCost = self.d[i,self._inactiveColumn] + ((self.t[self._counter-1] + self.t[self._counter-2]) ** 2 + self.beta)
-            # else:
-            #     duplicationCost = self.d[i,self._inactiveColumn] + ((self.t[self._counter-1] + 0) ** 2 + self.beta)
-            # if i > 1:
-            #     dropoutCost = self.d[i-1,self._activeColumn] + ((self.s[i-1] + self.s[i-2]) ** 2 + self.gamma)
-            # else:
-            #     dropoutCost = self.d[i-1,self._activeColumn] + ((self.s[i-1] + 0) ** 2 + self.gamma)
-            self.d[i][self._activeColumn] = min(duplicationCost, dropoutCost, transpositionCost)
+        cur[0] = prev[0] + self.beta + note ** 2
+        if self.margin is not None:
+            self._addNoteBand(prev, cur, note, ratio)
+            if DEBUG:
+                print(self.d) # print out the columns
+            return self._endNote()
+        # transposition and duplication terms for every row at once
+        transpositionCost = _scratchBuffer('tmp', len(self.s), cur.dtype)
+        np.subtract(self.s, note, out=transpositionCost, dtype=cur.dtype)
+        np.square(transpositionCost, out=transpositionCost)
+        transpositionCost += self.alpha
+        if ratio is not None:
+            _addRhythmCost(transpositionCost, self._ratios, ratio, self.rhythmWeight)
+        transpositionCost += prev[:-1]
+        duplicationCost = cur[1:]
+        np.add(prev[1:], note ** 2 + self.beta, out=duplicationCost)
+        np.minimum(duplicationCost, transpositionCost, out=duplicationCost)
+        # the dropout term chains down the column: cur[i] = min(cur[i], cur[i-1] + dropcost[i-1]).
+        # Unrolled, cur[i] = cumdrop[i] + min over k <= i of (cur[k] - cumdrop[k]),
+        # which is a min-plus prefix scan
+        scan = _scratchBuffer('scan', len(cur), cur.dtype)
+        np.subtract(cur, self._cumdrop, out=scan)
+        np.minimum.accumulate(scan, out=scan)
+        np.add(scan, self._cumdrop, out=cur)
+        self.rowsUpdated += len(cur)
+        self._locateMin(self._lastArgmin(cur, 1, len(self.s)))
         if DEBUG:
             print(self.d) # print out the columns
-        return self.getMatchVal(True)
+        return self._endNote()
 
-    def addNotes(self,notes):
+    def _endNote(self):
+        val = self.getMatchVal(True)
+        if self.window is not None:
+            self.trimHistory(self.window)
+        return val
+
+    def addNotes(self, notes, ratios=None):
         # return the match value for the last note
         assert(len(notes) > 0), "SONGMATCH, addNotes argument length is 0!"
+        if ratios is None:
+            ratios = [None] * len(notes)
         val = 0
-        for i in notes:
-            val = self.addNote([i])
+        for i, ratio in zip(notes, ratios):
+            val = self.addNote([i], ratio)
         return val
 
+    def _lastArgmin(self, cur, lo, hi):
+        # last row of the minimum of cur[lo:hi+1], as the scan keeps later
+        # rows on ties
+        col = cur[lo:hi+1]
+        return lo + len(col) - 1 - int(col[::-1].argmin())
+
+    def _locateMin(self, index):
+        # the column just computed has its minimum at row index, kept for
+        # getMatchVal
+        minval = self.d[index,self._activeColumn]
+        if minval > 10000:
+            minval = 10000
+            index = 0
+        self._minval = minval
+        self._minindex = index
+
     def getMatchVal(self, update = False):
-        nrow = len(self.s) + 1
-        minval = 10000
-        index = 0
-        for i in range(1, nrow):
-            if (self.d[i,self._activeColumn] <= minval):
-                index = i
-                minval = self.d[i,self._activeColumn]
         if update:
             # partial order matching
-            self.diffmat.append([index,self._counter])
-        return minval
+            if self._ntrace == len(self._trace):
+                self._trace = np.concatenate((self._trace, np.zeros_like(self._trace)))
+            self._trace[self._ntrace] = (self._minindex, self._counter)
+            self._ntrace += 1
+        return self._minval
+
+    def getLowerBound(self):
+        '''
+        return a lower bound on the match value after any further notes: no
+        entry of a later column can be below the current column minimum
+        '''
+        return self.d[:,self._activeColumn].min()
+
+    def getMatchIndex(self):
+        '''
+        return the song row where the best alignment of the notes so far ends
+        '''
+        return self._minindex
 
     def getCountVal(self):
         return self._counter
 
     def getKeyTempo(self, sfkey, tfkey, ttime):
-        skeyl = [sfkey]
-        tkeyl = [tfkey]
-        # reconstruct full key list
-        assert(len(ttime) == self._counter + 1),"SongMatchNew:getKeyTempo timelist and counter mismatch"
-        assert(len(self.diffmat) == self._counter), "SongMatchNew:getKeyTempo length of diffmat is wrong"
-        n = len(self.diffmat)
-        for i in range(0,n):
-            tkeyl.append(tkeyl[i] + self.t[i])
-        for i in range(0,len(self.s)):
-            skeyl.append(skeyl[i] + self.s[i])
-        # self.stime, ttime : tempo list
-        # skeyl, tkeyl : key list
-        if 1:
-            print("skeyl and tkeyl vals:")
-            print(skeyl)
-            print(tkeyl)
-            print("DIFFMAT: " + str(self.diffmat))
-            print("stime and ttime:")
-            print(self.stime)
-            print(ttime)
-        # key average algorithm:
-        keydifftotal = tfkey - sfkey
-        for i in self.diffmat:
-            keydifftotal += tkeyl[i[1]] - skeyl[i[0]]
-        keydiff = keydifftotal/(n+1)
-
-        # tempo crude average algorithm:
-        # temporatio = (ttime[self.diffmat[-1][1]] - ttime[0])/(self.stime[self.diffmat[-1][0]] - self.stime[0])
-        # temporatio = (self.stime[self.diffmat[-1][0]])/(ttime[self.diffmat[-1][1]])
-        temporatio = 0
-        tempolist = []
-        inserted = False
-        for i in range(1, len(self.diffmat)):
-            tempoval = (self.stime[self.diffmat[i][0]] - self.stime[self.diffmat[i-1][0]])/(ttime[self.diffmat[i][1]] - ttime[self.diffmat[i-1][1]])
-            tempolist.append(tempoval)
-        tempoval = (self.stime[self.diffmat[-1][0]-self.diffmat[0][0] + 1])/(ttime[self.diffmat[-1][1]])
-        tempolist.append(tempoval)
-        tempolist.append(tempoval)
-        tempolist.sort()
-        k = len(tempolist)//2
-        # unscented trasform
-        temporatio = 0.2 * tempolist[k-1] + 0.6 * tempolist[k] + 0.2 * tempolist[k+1]
+        # ttime holds one time per kept note, tfkey stays the first sung key
+        assert(len(ttime) == len(self.t) + 1),"SongMatchNew:getKeyTempo timelist and counter mismatch"
+        assert(len(self.diffmat) == len(self.t)), "SongMatchNew:getKeyTempo length of diffmat is wrong"
+        # note counts and key from the first kept note on
+        diffmat = self.diffmat - [0, self._dropped]
+        return keyTempo(self.s, self.stime, self.t, diffmat, sfkey, tfkey + self._droppedSum, ttime)
 
-        # where to play
-        startpt = self.stime[self.diffmat[-1][0]]
-        return [keydiff, temporatio, startpt]
+    def getKeyTempoTracker(self, sfkey, tfkey, durations):
+        '''
+        return a KeyTempoTracker caught up on the kept notes, durations holding
+        their [t_start, t_end]. Feed it every further note with getMatchIndex
+        '''
+        assert(len(durations) == len(self.t) + 1),"SongMatchNew:getKeyTempoTracker durations and counter mismatch"
+        tracker = KeyTempoTracker(self.s, self.stime, sfkey, tfkey + self._droppedSum, durations[0])
+        for interval, sidx, duration in zip(self.t, self.diffmat[:,0], durations[1:]):
+            tracker.addNote(interval, sidx, duration)
+        return tracker
 
 class SongMatch:
-    def __init__(self, songname = '', s=''):
+    def __init__(self, songname = '', s='', window=None):
         self.s = s # song DB
         self.t = '' # matching word
+        # sliding window mode: t only keeps the last window notes
+        assert(window is None or window >= 1), "SONGMATCH, window must hold at least one note"
+        self.window = window
         self.d = []
         self.songname = songname
         self.transpositionCost = 1
@@ -222,29 +872,48 @@ class SongMatch:
         self._inactiveColumn = 1
         self._modifySongFlag = True
         self._initizalized = False
+        self._bitParallel = False
 
     def modifySong(self,s):
         assert(self._modifySongFlag), "SONGMATCH, cannot modify song DB！"
         self.s = s
 
     def addNote(self,note):
-        # note is a single character string
+        # note is a single character string, or a single element list of intervals
         assert(len(note) == 1), "SONGMATCH, addNote argument length is not 1!"
+        if isinstance(self.t, str) and not isinstance(note, str):
+            self.t = list(self.t)
         self.t += note
+        if self.window is not None and len(self.t) > self.window:
+            self.t = self.t[-self.window:]
         self._counter += 1
-        nrow = len(self.s) + 1
         if (not self._initizalized):
             assert(self.s), "SONGMATCH, song DB string uninitialized"
-            self.d = np.zeros([nrow, 2])
-            for i in range(nrow):
-                self.d[i,0] = i
-            for j in range(2):
-                self.d[0,j] = j
+            # unit costs are the common case and can be computed bit-parallel
+            self._bitParallel = (self.transpositionCost == 1 and self.dropoutCost == 1
+                                 and self.duplicationCost == 1)
+            if self._bitParallel:
+                self._bp = BitParallelMatch(self.s)
+            else:
+                nrow = len(self.s) + 1
+                self.d = np.zeros([nrow, 2])
+                for i in range(nrow):
+                    self.d[i,0] = i
+                for j in range(2):
+                    self.d[0,j] = j
             self._initizalized = True
             self._modifySongFlag = False
             self._activeColumn = 0
             self._inactiveColumn = 1
 
+        if self._bitParallel:
+            self._bp.addNote(self.t[-1])
+        else:
+            self._addNoteMatrix()
+        return self.getMatchVal()
+
+    def _addNoteMatrix(self):
+        nrow = len(self.s) + 1
         # swap active and inactive column
         tmp = self._activeColumn
         self._activeColumn = self._inactiveColumn
@@ -252,7 +921,7 @@ class SongMatch:
         # initizalize the column value for the next iteration
         self.d[0,self._activeColumn] = self._counter
         for i in range(1,nrow):
-            if self.s[i-1] == self.t[self._counter-1]:
+            if self.s[i-1] == self.t[-1]:
                 subcost = 0
             else:
                 subcost = self.transpositionCost
@@ -260,7 +929,6 @@ class SongMatch:
              self.d[i,self._inactiveColumn]+self.dropoutCost, self.d[i-1,self._inactiveColumn]+subcost)
         if DEBUG:
             print(self.d) # print out the columns
-        return self.getMatchVal()
 
     def addNotes(self,notes):
         # return the match value for the last note
@@ -271,6 +939,8 @@ class SongMatch:
         return val
 
     def getMatchVal(self):
+        if self._bitParallel:
+            return float(self._bp.getMatchVal())
         nrow = len(self.s) + 1
         minval = self._counter + 1
         index = 0
@@ -284,7 +954,7 @@ class SongMatch:
         return self._counter
 
 class SongsMatch:
-    def __init__(self, dic):
+    def __init__(self, dic, window=None):
         self.songMatchDic = {}
         self.probDic = {}
         self.newprobDic = {}
@@ -295,7 +965,7 @@ class SongsMatch:
         initprob = 1.0/(len(dic)+1)
         for i in dic:
             # i is the name, dic[i] is s
-            self.songMatchDic[i] = SongMatch(i,dic[i])
+            self.songMatchDic[i] = SongMatch(i,dic[i],window)
             self.probDic[i] = initprob
         self.probDic[self._SONGNOTINDBSTR] = initprob
         return
@@ -331,60 +1001,671 @@ class SongsMatch:
         '''
         return self.probDic
 
-class SongsMatchNew:
-    def __init__(self, dic, timedic={}):
-        self.songMatchDic = {}
-        self.probDic = {}
-        self.newprobDic = {}
-        self.avgWeight = 0.5
-        self.notDBCost = 3
-        self._counter = 0
+class NameView(Mapping):
+    '''
+    Read-only dict view of a list or array through a name -> index mapping; the
+    optional extra name maps to the entry after the last indexed one
+    '''
+    def __init__(self, index, values, extra=None):
+        self._index = index
+        self._values = values
+        self._extra = extra
+
+    def __getitem__(self, name):
+        if name == self._extra and name is not None:
+            value = self._values[len(self._index)]
+        else:
+            value = self._values[self._index[name]]
+        return value.item() if isinstance(value, np.generic) else value
+
+    def __iter__(self):
+        yield from self._index
+        if self._extra is not None:
+            yield self._extra
+
+    def __len__(self):
+        return len(self._index) + (self._extra is not None)
+
+    def __contains__(self, name):
+        return name in self._index or (name == self._extra and name is not None)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+def _logSumExp(x):
+    if len(x) == 0:
+        return -np.inf
+    m = x.max()
+    return m + math.log(np.exp(x - m).sum())
+
+class _Posterior:
+    '''
+    Posterior over self.songNames followed by Others, kept in the log domain
+    (self.logprob) with self.prob as its exponential, and ranking queries
+    over it. The leader and runner-up are found once per note with linear
+    array passes and cached until the probabilities change
+    '''
+    def _initPosterior(self, nsong):
+        self.logprob = np.full(nsong + 1, -math.log(nsong + 1))
+        self.prob = np.exp(self.logprob)
+        # this note's normalized likelihoods
+        self.newprob = np.zeros(nsong + 1)
+        self._lognew = np.empty(nsong + 1)
+        self._ranked = None
+        self._logWeights = (None, 0.0, 0.0)
+
+    def _resetPosterior(self):
+        self.logprob.fill(-math.log(len(self.logprob)))
+        np.exp(self.logprob, out=self.prob)
+        self.newprob.fill(0)
+        self._ranked = None
+
+    def _updatePosterior(self, cost):
+        # negative cost is the log likelihood of a song, Others costs notDBCost
+        # per note; normalized with log-sum-exp so nothing underflows
+        lognew = self._lognew
+        np.negative(cost, out=lognew[:-1], casting='unsafe')
+        lognew[-1] = - self._counter * self.notDBCost
+        lognew -= lognew.max()
+        np.exp(lognew, out=self.newprob)
+        total = self.newprob.sum()
+        self.newprob /= total
+        lognew -= math.log(total)
+        # prob = avgWeight * prob + (1-avgWeight) * newprob
+        if self._logWeights[0] != self.avgWeight:
+            with np.errstate(divide='ignore'):
+                self._logWeights = (self.avgWeight, np.log(self.avgWeight), np.log(1 - self.avgWeight))
+        self.logprob += self._logWeights[1]
+        lognew += self._logWeights[2]
+        np.logaddexp(self.logprob, lognew, out=self.logprob)
+        np.exp(self.logprob, out=self.prob)
+        self._ranked = None
+
+    def getProbs(self):
+        '''
+        return the probability array, indexed by songIndex with Others last
+        '''
+        self._applyReset()
+        probs = self.prob.view()
+        probs.flags.writeable = False
+        return probs
+
+    def _ranking(self):
+        self._applyReset()
+        if self._ranked is None:
+            prob = self.prob
+            # last index among equal maxima, as sorting the dict items and
+            # taking the last one does
+            best = len(prob) - 1 - int(np.argmax(prob[::-1]))
+            second = np.partition(prob, len(prob) - 2)[-2] if len(prob) > 1 else 0.0
+            self._ranked = (best, float(prob[best]), float(second))
+        return self._ranked
+
+    def _rankName(self, j):
+        return self.songNames[j] if j < len(self.songNames) else self._SONGNOTINDBSTR
+
+    def top(self, k):
+        '''
+        return the k most probable (name, probability) pairs, best first
+        '''
+        self._applyReset()
+        prob = self.prob
+        k = min(k, len(prob))
+        ids = np.argpartition(-prob, k - 1)[:k]
+        # ties go to the later entry, as for best
+        ids = ids[np.lexsort((-ids, -prob[ids]))]
+        return [(self._rankName(j), float(prob[j])) for j in ids]
+
+    def best(self):
+        '''
+        return the most probable (name, probability), Others included
+        '''
+        best, prob, second = self._ranking()
+        return self._rankName(best), prob
+
+    def margin(self):
+        '''
+        return the probability lead of the best entry over the runner-up
+        '''
+        best, prob, second = self._ranking()
+        return prob - second
+
+    def confident(self, threshold=0.8, margin=0.0):
+        '''
+        return True when a song, not Others, is above threshold and leads the
+        runner-up by at least margin
+        '''
+        best, prob, second = self._ranking()
+        return best < len(self.songNames) and prob > threshold and prob - second >= margin
+
+class SongsMatchNew(_Posterior):
+    def __init__(self, dic, timedic={}, margin=None, suspendProb=None, window=None, rhythmWeight=None):
         self._SONGNOTINDBSTR = 'Others'
-        initprob = 1.0/(len(dic)+1)
+        # songs are addressed by index, names only go through songIndex
+        self.songNames = list(dic)
+        self.songIndex = {name: j for j, name in enumerate(self.songNames)}
+        self.matchers = []
         for i in dic:
             # i is the name, dic[i] is s
             if i not in timedic:
-                self.songMatchDic[i] = SongMatchNew(i,dic[i])
+                self.matchers.append(SongMatchNew(i,dic[i],margin=margin,window=window,rhythmWeight=rhythmWeight))
             else:
-                self.songMatchDic[i] = SongMatchNew(i,dic[i],timedic[i])
-            self.probDic[i] = initprob
-        self.probDic[self._SONGNOTINDBSTR] = initprob
+                self.matchers.append(SongMatchNew(i,dic[i],timedic[i],margin,window,rhythmWeight))
+        nsong = len(self.songNames)
+        # probabilities of every song, Others last
+        self._initPosterior(nsong)
+        self.cost = np.zeros(nsong)
+        self.songMatchDic = NameView(self.songIndex, self.matchers)
+        self.probDic = NameView(self.songIndex, self.prob, self._SONGNOTINDBSTR)
+        self.newprobDic = NameView(self.songIndex, self.newprob, self._SONGNOTINDBSTR)
+        self.avgWeight = 0.5
+        self.notDBCost = 3
+        # songs whose probability falls below suspendProb stop being updated until
+        # a lower bound on their cost says they could come back, None disables it
+        self.suspendProb = suspendProb
+        self.skippedUpdates = 0
+        # sliding window mode, see SongMatchNew
+        self.window = window
+        self.t = []
+        self.ratios = [] # sung onset ratio of every note of t, or None
+        self._tdropped = 0 # notes trimmed off the front of t
+        self._suspendedAt = np.full(nsong, -1) # number of notes seen when suspended
+        self._counter = 0
+        self._resetPending = False
+        if suspendProb is not None:
+            self._initBounds(dic)
         return
 
-    def addNote(self, note):
-        cost = {}
-        totalsum = 0
-        for i in self.songMatchDic:
-            # negative cost is used
-            cost[i] = self.songMatchDic[i].addNote(note)
-            self._counter = self.songMatchDic[i].getCountVal()
-            self.newprobDic[i] = math.exp(-cost[i])
-            totalsum += self.newprobDic[i]
-        # update NOTINDB case
-        self.newprobDic[self._SONGNOTINDBSTR] = math.exp(- self._counter * self.notDBCost)
-        totalsum += self.newprobDic[self._SONGNOTINDBSTR]
+    def reset(self):
+        '''
+        start matching from scratch, as a newly built SongsMatchNew. Only marks
+        the state stale, the songs are reset when they are next used
+        '''
+        self.t = []
+        self.ratios = []
+        self._tdropped = 0
+        self._counter = 0
+        self.skippedUpdates = 0
+        self._resetPending = True
 
-        for i in self.newprobDic:
-            self.probDic[i] = self.avgWeight * self.probDic[i] + (1-self.avgWeight) * self.newprobDic[i]/totalsum
-        return cost
+    def _applyReset(self):
+        if not self._resetPending:
+            return
+        self._resetPending = False
+        for matcher in self.matchers:
+            matcher.reset()
+        self._resetPosterior()
+        self.cost.fill(0)
+        self._suspendedAt.fill(-1)
+        if self.suspendProb is not None:
+            self._bound.fill(0)
 
-    def addNotes(self,notes):
+    def snapshot(self):
+        '''
+        return a copy of the matching state, to be passed to restore
+        '''
+        self._applyReset()
+        bound = self._bound.copy() if self.suspendProb is not None else None
+        return ([matcher.snapshot() for matcher in self.matchers], self.logprob.copy(),
+                self.newprob.copy(), self.cost.copy(), list(self.t), list(self.ratios),
+                self._tdropped, self._counter, self._suspendedAt.copy(), bound, self.skippedUpdates)
+
+    def restore(self, state):
+        '''
+        go back to the matching state returned by snapshot
+        '''
+        (matchers, logprob, newprob, cost, t, ratios, tdropped, counter, suspendedAt, bound,
+         skippedUpdates) = state
+        assert(len(matchers) == len(self.matchers)), "SONGSMATCHNEW, restore state is from another catalog"
+        self._resetPending = False
+        self._ranked = None
+        for matcher, matcherState in zip(self.matchers, matchers):
+            matcher.restore(matcherState)
+        # copied into the arrays behind the name views
+        self.logprob[:] = logprob
+        np.exp(self.logprob, out=self.prob)
+        self.newprob[:] = newprob
+        self.cost[:] = cost
+        self._suspendedAt[:] = suspendedAt
+        if bound is not None:
+            self._bound[:] = bound
+        self.t = list(t)
+        self.ratios = list(ratios)
+        self._tdropped = tdropped
+        self._counter = counter
+        self.skippedUpdates = skippedUpdates
+
+    def _resumeBefore(self, first):
+        # suspended songs catch up before the notes they miss are dropped
+        for j in np.flatnonzero((self._suspendedAt >= 0) & (self._suspendedAt < first)):
+            self._resume(j)
+
+    def _trimNotes(self, nkeep):
+        first = self._counter - nkeep # count of the first note kept
+        if first <= self._tdropped:
+            return
+        self._resumeBefore(first)
+        del self.t[:first - self._tdropped]
+        del self.ratios[:first - self._tdropped]
+        self._tdropped = first
+
+    def trimHistory(self, nkeep):
+        '''
+        keep only the last nkeep notes, see SongMatchNew.trimHistory
+        '''
+        assert(nkeep >= 1), "SONGSMATCHNEW, trimHistory must keep at least one note"
+        self._applyReset()
+        self._trimNotes(nkeep)
+        for matcher in self.matchers:
+            matcher.trimHistory(nkeep)
+
+    def _initBounds(self, dic):
+        # every note costs a song at least min(alpha + (s_k - note)^2 over its
+        # intervals s_k, beta + note^2), tabulated here for the usual note range
+        self._bound = np.zeros(len(dic))
+        self._intervals = [np.unique(matcher.s.astype(float)) for matcher in self.matchers]
+        self._noteRange = 24
+        notes = np.arange(-self._noteRange, self._noteRange + 1)
+        self._nearest = np.array([((u[:,None] - notes) ** 2).min(axis=0) for u in self._intervals])
+        self._alpha = self.matchers[0].alpha
+        self._beta = self.matchers[0].beta
+
+    def _raiseBounds(self, note):
+        if abs(note) <= self._noteRange:
+            nearest = self._nearest[:,int(note) + self._noteRange]
+        else:
+            nearest = np.array([((u - note) ** 2).min() for u in self._intervals])
+        self._bound += np.minimum(nearest + self._alpha, note ** 2 + self._beta)
+
+    def _resume(self, j):
+        # catch the song up on the notes sung while it was suspended
+        since = self._suspendedAt[j]
+        self._suspendedAt[j] = -1
+        notes = self.t[since - self._tdropped:]
+        if not notes:
+            return self.matchers[j].getMatchVal()
+        return self.matchers[j].addNotes(notes, self.ratios[since - self._tdropped:])
+
+    def addNote(self, note, ratio=None):
+        # ratio is the onsetRatios entry of the sung interval, for rhythm mode
+        self._applyReset()
+        if self.window is not None and self.suspendProb is not None:
+            # resume now rather than after this note's costs are computed
+            self._resumeBefore(self._counter + 1 - self.window)
+        self.t += note
+        self.ratios.append(ratio)
+        self._counter += 1
+        suspended = np.flatnonzero(self._suspendedAt >= 0) if self.suspendProb is not None else []
+        if len(suspended):
+            self._raiseBounds(note[0])
+        cost = self.cost
+        for j, matcher in enumerate(self.matchers):
+            if self._suspendedAt[j] >= 0:
+                continue
+            cost[j] = matcher.addNote(note, ratio)
+        if len(suspended):
+            # a song comes back once exp(-bound) exceeds suspendProb times the
+            # summed likelihood of the active songs, compared in the log domain
+            active = -cost[self._suspendedAt < 0]
+            threshold = math.log(self.suspendProb) + _logSumExp(active)
+            for j in suspended:
+                bound = min(self._bound[j], 10000)
+                if -bound > threshold:
+                    # could re-enter contention
+                    cost[j] = self._resume(j)
+                else:
+                    # the bound stands in for the cost, which can only be higher
+                    cost[j] = bound
+                    self.skippedUpdates += 1
+        self._updatePosterior(cost)
+        if self.suspendProb is not None:
+            for j in np.flatnonzero((self.prob[:-1] < self.suspendProb) & (self._suspendedAt < 0)):
+                self._suspendedAt[j] = self._counter
+                self._bound[j] = self.matchers[j].getLowerBound()
+        if self.window is not None:
+            # the songs trim their own notes
+            self._trimNotes(self.window)
+        return dict(zip(self.songNames, cost.tolist()))
+
+    def addNotes(self, notes, ratios=None):
         # return the match value for the last note
         assert(len(notes) > 0), "SONGSMATCH, addNotes argument length is 0!"
+        if ratios is None:
+            ratios = [None] * len(notes)
         cost = {}
-        for j in notes:
-            cost = self.addNote([j])
+        for j, ratio in zip(notes, ratios):
+            cost = self.addNote([j], ratio)
         return cost
 
     def getProbDic(self):
         '''
-        return the dictionary of probability
+        return the dictionary of probability, a read-only view of self.prob
         '''
+        self._applyReset()
         return self.probDic
 
+    def getBandSizes(self):
+        '''
+        return the dictionary of active band sizes, see SongMatchNew.getBandSize
+        '''
+        self._applyReset()
+        return {i: self.matchers[j].getBandSize() for j, i in enumerate(self.songNames)}
+
+    def getSkippedUpdates(self):
+        '''
+        return the number of song updates saved by suspending songs
+        '''
+        return self.skippedUpdates
+
+    def getKeyTempo(self, songname, sfkey, tfkey, ttime):
+        assert(songname in self.songIndex), "SONGSMATCHNEW, getKeyTempo invalid song name"
+        self._applyReset()
+        j = self.songIndex[songname]
+        if self._suspendedAt[j] >= 0:
+            self._resume(j)
+        return self.matchers[j].getKeyTempo(sfkey, tfkey, ttime)
+
+    def getMatchIndex(self, songname):
+        '''
+        return the song row where the best alignment of songname ends
+        '''
+        self._applyReset()
+        j = self.songIndex[songname]
+        if self._suspendedAt[j] >= 0:
+            self._resume(j)
+        return self.matchers[j].getMatchIndex()
+
+    def getKeyTempoTracker(self, songname, sfkey, tfkey, durations):
+        assert(songname in self.songIndex), "SONGSMATCHNEW, getKeyTempoTracker invalid song name"
+        self._applyReset()
+        j = self.songIndex[songname]
+        if self._suspendedAt[j] >= 0:
+            self._resume(j)
+        return self.matchers[j].getKeyTempoTracker(sfkey, tfkey, durations)
+
+class SongsMatchBatch(_Posterior):
+    '''
+    Drop-in alternative to SongsMatchNew: the DP columns of every song are
+    packed back to back into one flat array (a segment of len(s)+1 rows per
+    song) and the DP for the whole catalog is advanced with a single set of
+    array operations per note. Intervals must be whole semitones
+    '''
+    def __init__(self, dic, timedic={}, window=None, rhythmWeight=None):
+        assert(len(dic) > 0), "SONGSMATCHBATCH, song dictionary is empty!"
+        self.songNames = list(dic)
+        self.songIndex = {name: i for i, name in enumerate(self.songNames)}
+        self.timedic = timedic
+        self.avgWeight = 0.5
+        self.notDBCost = 3
+        self.alpha = 0 # transpose fix cost
+        self.beta = 5 # duplicate fix cost
+        self.gamma = 1 # dropout fix cost
+        # sliding window mode, see SongMatchNew
+        assert(window is None or window >= 1), "SONGSMATCHBATCH, window must hold at least one note"
+        self.window = window
+        nsong = len(self.songNames)
+        # matching word and best ending row of every song after every note,
+        # grown by doubling. Trimmed notes are left in front of _first until
+        # the space is reused
+        self._tbuf = np.zeros(16, dtype=np.int32)
+        self._trace = np.zeros([16, nsong], dtype=np.int32)
+        self._first = 0
+        self._dropped = 0 # number of notes trimmed
+        self._droppedSum = 0 # sum of the intervals trimmed
+        self._counter = 0
+        self._SONGNOTINDBSTR = 'Others'
+        lengths = np.array([len(dic[i]) for i in self.songNames])
+        assert(lengths.min() > 0), "SONGSMATCHBATCH, song DB string uninitialized"
+        self.lengths = lengths
+        # first row of every song segment, and one past the last row
+        self._starts = np.zeros(nsong + 1, dtype=np.int64)
+        np.cumsum(lengths + 1, out=self._starts[1:])
+        nrow = int(self._starts[-1])
+        # _s[p] is the interval entering row p, 0 on the first row of a segment
+        s = np.zeros(nrow)
+        for i, name in enumerate(self.songNames):
+            s[self._starts[i]+1:self._starts[i+1]] = dic[name]
+        assert(np.array_equal(s, np.round(s)) and np.abs(s).max() <= 32767), \
+            "SONGSMATCHBATCH, intervals must be whole semitones"
+        self._s = s.astype(np.int16)
+        # dropout cost of the rows above, restarted at every segment. The
+        # segmented minimum scan runs over one flat array: an offset of
+        # _SEGMENT per segment puts every value of a segment below every value
+        # of the segments before it, so no minimum leaks across songs
+        dropcost = self._s.astype(np.int64) ** 2 + self.gamma
+        dropcost[self._starts[:-1]] = 0
+        cumdrop = np.cumsum(dropcost)
+        cumdrop -= np.repeat(cumdrop[self._starts[:-1]], lengths + 1)
+        self._SEGMENT = 2**34
+        self._offset = cumdrop + self._SEGMENT * np.repeat(np.arange(nsong, dtype=np.int64), lengths + 1)
+        self._rowkey = np.arange(nrow - 1, -1, -1, dtype=np.int32)
+        # reduceat boundaries, rows 1.. of every segment interleaved with the
+        # first rows, whose reductions are dropped
+        self._segments = np.empty(2*nsong - 1, dtype=np.int64)
+        self._segments[0::2] = self._starts[:-1] + 1
+        self._segments[1::2] = self._starts[1:-1]
+        # rhythm mode, see SongMatchNew: the song onset ratio entering every row
+        # but the first, with a zero weight for songs without timestamps
+        self.rhythmWeight = rhythmWeight
+        self._ratios = None
+        if rhythmWeight is not None:
+            self._ratios = np.zeros(nrow - 1, dtype=np.float32)
+            self._rhythmWeights = np.zeros(nrow - 1, dtype=np.float32)
+            for i, name in enumerate(self.songNames):
+                ratios = songOnsetRatios(dic[name], timedic.get(name, []))
+                if ratios is not None:
+                    self._ratios[self._starts[i]:self._starts[i+1]-1] = ratios
+                    self._rhythmWeights[self._starts[i]:self._starts[i+1]-1] = rhythmWeight
+        self._prev = np.empty(nrow, dtype=np.int32)
+        self._cur = cumdrop.astype(np.int32)
+        self.cost = np.zeros(nsong, dtype=np.int32)
+        self._initPosterior(nsong) # last entry is Others
+        self._probDic = None
+        self._resetPending = False
+        return
+
+    def reset(self):
+        '''
+        start matching from scratch, as a newly built SongsMatchBatch. Only marks
+        the state stale, the columns are reset when they are next used
+        '''
+        self._counter = 0
+        self._first = 0
+        self._dropped = 0
+        self._droppedSum = 0
+        self._resetPending = True
+        self._probDic = None
+        self._ranked = None
+
+    def _applyReset(self):
+        if not self._resetPending:
+            return
+        self._resetPending = False
+        # the initial column is the dropout cost, the low bits of the offsets
+        np.bitwise_and(self._offset, self._SEGMENT - 1, out=self._cur, casting='unsafe')
+        self.cost.fill(0)
+        self._resetPosterior()
+
+    def snapshot(self):
+        '''
+        return a copy of the matching state, to be passed to restore
+        '''
+        self._applyReset()
+        n = self._counter - self._dropped
+        return (self.t.copy(), self._trace[self._first:self._first + n].copy(), self._cur.copy(),
+                self.cost.copy(), self.logprob.copy(), self._counter, self._dropped, self._droppedSum)
+
+    def restore(self, state):
+        '''
+        go back to the matching state returned by snapshot
+        '''
+        t, trace, cur, cost, logprob, counter, dropped, droppedSum = state
+        assert(len(cur) == len(self._cur)), "SONGSMATCHBATCH, restore state is from another catalog"
+        self._resetPending = False
+        self._counter = counter
+        self._first = 0
+        self._dropped = dropped
+        self._droppedSum = droppedSum
+        if len(self._tbuf) < len(t):
+            self._tbuf = np.zeros(len(t), dtype=np.int32)
+            self._trace = np.zeros([len(t), len(self.songNames)], dtype=np.int32)
+        self._tbuf[:len(t)] = t
+        self._trace[:len(trace)] = trace
+        self._cur[:] = cur
+        self.cost[:] = cost
+        self.logprob[:] = logprob
+        np.exp(self.logprob, out=self.prob)
+        self._probDic = None
+        self._ranked = None
+
+    def addNote(self, note, ratio=None):
+        # note is a single element list and ratio the sung onset ratio, as for
+        # SongsMatchNew
+        assert(len(note) == 1), "SONGSMATCHBATCH, addNote argument length is not 1!"
+        self._applyReset()
+        end = self._first + self._counter - self._dropped
+        if end == len(self._tbuf):
+            self._reserve()
+            end = self._first + self._counter - self._dropped
+        self._tbuf[end] = note[0]
+        assert(self._tbuf[end] == note[0]), "SONGSMATCHBATCH, songs are matched on whole notes"
+        self._counter += 1
+        note = int(note[0])
+        self._prev, self._cur = self._cur, self._prev
+        prev = self._prev
+        cur = self._cur
+        nrow = len(cur)
+        firsts = self._starts[:-1]
+        # same recurrence as SongMatchNew.addNote, one segment per song
+        transpositionCost = _scratchBuffer('batch', nrow - 1, np.int32)
+        np.subtract(self._s[1:], note, out=transpositionCost, dtype=np.int32)
+        np.square(transpositionCost, out=transpositionCost)
+        transpositionCost += self.alpha
+        if ratio is not None and self._ratios is not None:
+            _addRhythmCost(transpositionCost, self._ratios, ratio, self._rhythmWeights)
+        transpositionCost += prev[:-1]
+        duplicationCost = cur[1:]
+        np.add(prev[1:], note ** 2 + self.beta, out=duplicationCost)
+        np.minimum(duplicationCost, transpositionCost, out=duplicationCost)
+        # the first row of a segment can only be a duplication
+        cur[firsts] = prev[firsts] + (self.beta + note ** 2)
+        scan = _scratchBuffer('batchscan', nrow, np.int64)
+        np.subtract(cur, self._offset, out=scan)
+        np.minimum.accumulate(scan, out=scan)
+        scan += self._offset
+        cur[:] = scan
+
+        # best ending row of every song, last index on ties as in SongMatchNew:
+        # the row goes into the low digits of the key so one minimum finds both
+        key = scan
+        key *= nrow
+        key += self._rowkey
+        best = np.minimum.reduceat(key, self._segments)[::2]
+        cost = best // nrow
+        index = (nrow - 1 - best % nrow) - firsts
+        capped = cost > 10000
+        cost[capped] = 10000
+        index[capped] = 0
+        self._trace[end] = index
+        self.cost[:] = cost
+
+        self._updatePosterior(self.cost)
+        self._probDic = None
+        if self.window is not None:
+            self.trimHistory(self.window)
+        return dict(zip(self.songNames, self.cost.tolist()))
+
+    def _reserve(self):
+        # room for one more note at the end of the buffers, as in SongMatchNew
+        n = self._counter - self._dropped
+        if self._first >= len(self._tbuf) // 2:
+            self._tbuf[:n] = self._tbuf[self._first:self._first + n]
+            self._trace[:n] = self._trace[self._first:self._first + n]
+            self._first = 0
+        else:
+            self._tbuf = np.concatenate((self._tbuf, np.zeros_like(self._tbuf)))
+            self._trace = np.concatenate((self._trace, np.zeros_like(self._trace)))
+
+    def trimHistory(self, nkeep):
+        '''
+        keep only the last nkeep notes, see SongMatchNew.trimHistory
+        '''
+        assert(nkeep >= 1), "SONGSMATCHBATCH, trimHistory must keep at least one note"
+        drop = self._counter - self._dropped - nkeep
+        if drop <= 0:
+            return
+        self._droppedSum += int(self._tbuf[self._first:self._first + drop].sum())
+        self._first += drop
+        self._dropped += drop
+
+    def addNotes(self, notes, ratios=None):
+        # return the match value for the last note
+        assert(len(notes) > 0), "SONGSMATCHBATCH, addNotes argument length is 0!"
+        if ratios is None:
+            ratios = [None] * len(notes)
+        cost = {}
+        for j, ratio in zip(notes, ratios):
+            cost = self.addNote([j], ratio)
+        return cost
+
+    def getProbDic(self):
+        '''
+        return the dictionary of probability
+        '''
+        self._applyReset()
+        if self._probDic is None:
+            self._probDic = dict(zip(self.songNames + [self._SONGNOTINDBSTR], self.prob.tolist()))
+        return self._probDic
+
+    def getDiffmat(self, songname):
+        '''
+        return the [song index, note count] alignment list of one song, aligned
+        with t
+        '''
+        j = self.songIndex[songname]
+        n = self._counter - self._dropped
+        diffmat = np.empty([n, 2], dtype=np.int64)
+        diffmat[:,0] = self._trace[self._first:self._first + n,j]
+        diffmat[:,1] = np.arange(self._dropped + 1, self._counter + 1)
+        return diffmat
+
     def getKeyTempo(self, songname, sfkey, tfkey, ttime):
-        assert(songname in self.songMatchDic), "SONGSMATCHNEW, getKeyTempo invalid song name"
-        return self.songMatchDic[songname].getKeyTempo(sfkey, tfkey, ttime)
+        assert(songname in self.songIndex), "SONGSMATCHBATCH, getKeyTempo invalid song name"
+        # ttime holds one time per kept note, tfkey stays the first sung key
+        assert(len(ttime) == len(self.t) + 1),"SONGSMATCHBATCH, getKeyTempo timelist and counter mismatch"
+        j = self.songIndex[songname]
+        s = self._s[self._starts[j]+1:self._starts[j+1]].tolist()
+        stime = self.timedic.get(songname, [])
+        # note counts and key from the first kept note on
+        diffmat = self.getDiffmat(songname) - [0, self._dropped]
+        return keyTempo(s, stime, self.t, diffmat, sfkey, tfkey + self._droppedSum, ttime)
+
+    def getKeyTempoTracker(self, songname, sfkey, tfkey, durations):
+        '''
+        see SongMatchNew.getKeyTempoTracker, further notes are fed with getMatchIndex
+        '''
+        assert(songname in self.songIndex), "SONGSMATCHBATCH, getKeyTempoTracker invalid song name"
+        assert(len(durations) == len(self.t) + 1),"SONGSMATCHBATCH, getKeyTempoTracker durations and counter mismatch"
+        j = self.songIndex[songname]
+        s = self._s[self._starts[j]+1:self._starts[j+1]]
+        stime = self.timedic.get(songname, [])
+        tracker = KeyTempoTracker(s, stime, sfkey, tfkey + self._droppedSum, durations[0])
+        for interval, sidx, duration in zip(self.t, self.getDiffmat(songname)[:,0], durations[1:]):
+            tracker.addNote(interval, sidx, duration)
+        return tracker
+
+    def getMatchIndex(self, songname):
+        '''
+        return the song row where the best alignment of songname ends
+        '''
+        return int(self._trace[self._first + self._counter - self._dropped - 1, self.songIndex[songname]])
+
+    @property
+    def t(self):
+        '''
+        the notes matched so far, the last window notes in sliding window mode
+        '''
+        return self._tbuf[self._first:self._first + self._counter - self._dropped]
 
 
 
@@ -401,10 +1682,16 @@ if __name__ == "__main__":
     test1 = SongsMatchNew({'test1':[1,2,3]})
     print(test1.addNotes([1,1,3]))
     print(test1.getProbDic())
-    print(test1.songMatchDic['test1'].diffmat)
+    print(test1.songMatchDic['test1'].diffmat.tolist())
     print("------test2------")
     test2 = SongsMatchNew({'test2':[1,1,1]},{'test2':[0,1,2,3]})
     print(test2.addNotes([0,0,0]))
     print(test2.getProbDic())
-    print(test2.songMatchDic['test2'].diffmat)
+    print(test2.songMatchDic['test2'].diffmat.tolist())
     print(test2.getKeyTempo('test2',12,12,[1,2,5,7]))
+    print("------test3------")
+    test3 = SongsMatchBatch({'test2':[1,1,1]},{'test2':[0,1,2,3]})
+    print(test3.addNotes([0,0,0]))
+    print(test3.getProbDic())
+    print(test3.getDiffmat('test2').tolist())
+    print(test3.getKeyTempo('test2',12,12,[1,2,5,7]))
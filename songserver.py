@@ -0,0 +1,649 @@
+"""
+Catalog shards served over TCP, for catalogs too large for one machine. A
+shard server holds a slice of the songs and one SongsMatchBatch per matching
+session; SongsMatchRemote talks to every shard and keeps the posterior over
+the whole catalog, as SongsMatchSharded does with local processes.
+
+Every message is one line of JSON, optionally followed by "nbytes" bytes of
+raw little endian int32 data. Requests carry an "id" and an "op", replies echo
+the "id" and say "ok" (or give an "error"):
+    songs                             -> names of the songs of the shard
+    open     session window rhythmWeight
+                                      start a session
+    advance  sessions: [[session, count, notes, ratios], ...]
+                                      -> counts, then one int32 cost row per
+                                         note and session, songs in shard order
+    reset    session
+    trim     session nkeep
+    index    session song             -> index, see getMatchIndex
+    align    session song             -> s, stime, sidx, droppedSum, the
+                                         alignment of the kept notes
+    close    session
+count is the number of notes the session has seen before the new notes, a
+request that is out of step is refused. ratios, the sung onset ratios of the
+notes (see SongMatchNew.addNote), may be left out.
+"""
+import json
+import selectors
+import socket
+import socketserver
+import threading
+import time
+import multiprocessing
+import numpy as np
+from songmatch import SongsMatchBatch, KeyTempoTracker, keyTempo, NameView, _Posterior
+
+def _encode(header, payload=b''):
+    if payload:
+        header['nbytes'] = len(payload)
+    return json.dumps(header).encode() + b'\n' + payload
+
+def _send(sock, header, payload=b''):
+    sock.sendall(_encode(header, payload))
+
+def _parse(buf):
+    # one complete message off the front of buf, or None
+    end = buf.find(b'\n')
+    if end < 0:
+        return None
+    header = json.loads(bytes(buf[:end]))
+    nbytes = header.get('nbytes', 0)
+    if len(buf) < end + 1 + nbytes:
+        return None
+    payload = bytes(buf[end + 1:end + 1 + nbytes])
+    del buf[:end + 1 + nbytes]
+    return header, payload
+
+class _ShardHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        buf = bytearray()
+        while True:
+            message = _parse(buf)
+            if message is None:
+                try:
+                    data = self.request.recv(1 << 16)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buf += data
+                continue
+            request, payload = message
+            reply = {'id': request.get('id'), 'ok': True}
+            payload = b''
+            try:
+                with server.lock:
+                    payload = server.serve(request, reply)
+            except Exception as e:
+                reply = {'id': request.get('id'), 'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+                payload = b''
+            try:
+                _send(self.request, reply, payload)
+            except OSError:
+                return
+
+class ShardServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    '''
+    TCP server for the songs of dic, one thread per connection. Sessions are
+    shared by all connections. delay seconds are slept before every advance,
+    to stand in for a slow node
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, dic, timedic={}, address=('127.0.0.1', 0), delay=0.0):
+        assert(len(dic) > 0), "SHARDSERVER, song dictionary is empty!"
+        socketserver.TCPServer.__init__(self, address, _ShardHandler)
+        self.dic = dic
+        self.timedic = timedic
+        self.songNames = list(dic)
+        self.delay = delay
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def _session(self, request):
+        assert(request['session'] in self.sessions), "SHARDSERVER, unknown session"
+        return self.sessions[request['session']]
+
+    def serve(self, request, reply):
+        # fill reply for one request, returns the binary payload
+        op = request['op']
+        if op == 'songs':
+            reply['songs'] = self.songNames
+        elif op == 'open':
+            self.sessions[request['session']] = SongsMatchBatch(self.dic, self.timedic, window=request.get('window'),
+                                                                rhythmWeight=request.get('rhythmWeight'))
+        elif op == 'advance':
+            if self.delay:
+                time.sleep(self.delay)
+            counts = []
+            rows = []
+            for entry in request['sessions']:
+                session, count, notes = entry[:3]
+                ratios = entry[3] if len(entry) > 3 else [None] * len(notes)
+                matcher = self._session({'session': session})
+                assert(matcher._counter == count), "SHARDSERVER, session is out of step"
+                for note, ratio in zip(notes, ratios):
+                    matcher.addNote([note], ratio)
+                    rows.append(matcher.cost.copy())
+                counts.append(matcher._counter)
+            reply['counts'] = counts
+            return np.asarray(rows, dtype='<i4').tobytes()
+        elif op == 'reset':
+            self._session(request).reset()
+        elif op == 'trim':
+            self._session(request).trimHistory(request['nkeep'])
+        elif op == 'index':
+            reply['index'] = self._session(request).getMatchIndex(request['song'])
+        elif op == 'align':
+            matcher = self._session(request)
+            song = request['song']
+            reply['s'] = [float(x) for x in self.dic[song]]
+            reply['stime'] = [float(x) for x in self.timedic.get(song, [])]
+            reply['sidx'] = matcher.getDiffmat(song)[:,0].tolist()
+            reply['droppedSum'] = matcher._droppedSum
+        elif op == 'close':
+            self.sessions.pop(request['session'], None)
+        else:
+            assert(False), "SHARDSERVER, unknown op %s" % op
+        return b''
+
+def serveSongs(allSongNames, address, delay=0.0):
+    '''
+    serve the musicbank songs allSongNames on address until interrupted
+    '''
+    from song import SongDatabase
+    songdb = SongDatabase(allSongNames)
+    songdb.preprocessMelodies()
+    server = ShardServer(songdb.getAllMelody(), songdb.getAllTimestamps(), address, delay)
+    with server:
+        server.serve_forever()
+
+def _serveLocal(conn, dic, timedic, delay):
+    server = ShardServer(dic, timedic, ('127.0.0.1', 0), delay)
+    conn.send(server.server_address)
+    conn.close()
+    with server:
+        server.serve_forever()
+
+class LocalShards:
+    '''
+    Stand-in for remote nodes: nshards ShardServer processes on localhost over
+    contiguous slices of dic, delays[k] being the delay of shard k. addresses
+    are the (host, port) pairs to give to SongsMatchRemote
+    '''
+    def __init__(self, dic, nshards, timedic={}, delays=None):
+        names = list(dic)
+        assert(1 <= nshards <= len(names)), "LOCALSHARDS, need between 1 and len(dic) shards"
+        if delays is None:
+            delays = [0.0] * nshards
+        bounds = np.linspace(0, len(names), nshards + 1).astype(int)
+        self.addresses = []
+        self.procs = []
+        for k in range(nshards):
+            shard = {name: dic[name] for name in names[bounds[k]:bounds[k+1]]}
+            shardtime = {name: timedic[name] for name in shard if name in timedic}
+            parent, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_serveLocal, args=(child, shard, shardtime, delays[k]), daemon=True)
+            proc.start()
+            child.close()
+            self.addresses.append(tuple(parent.recv()))
+            parent.close()
+            self.procs.append(proc)
+
+    def close(self):
+        for proc in self.procs:
+            proc.terminate()
+            proc.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class _ShardLink:
+    # client end of one shard connection
+    def __init__(self, address, lo, sock):
+        self.address = address
+        self.lo = lo
+        self.sock = sock
+        self.buf = bytearray()
+        self.out = bytearray() # requests the socket has not taken yet
+        self.events = selectors.EVENT_READ
+        self.expected = {} # request id -> (op, epoch)
+        self.replies = {} # answers to synchronous requests, by id
+        self.count = 0 # notes answered in the current epoch
+        self.sent = 0 # notes sent in the current epoch
+        self.latest = None # the newest cost row received
+        self.down = False
+
+class SongsMatchRemote(_Posterior):
+    '''
+    Same interface as SongsMatchNew, over the ShardServers at addresses. Every
+    note is sent to every shard; a shard that has not answered within timeout
+    seconds is left behind for that note, and one already behind is not
+    waited for. The default timeout fits in the 11.6ms of an audio callback
+    (512 samples at 44.1kHz) with room for the matching. Its songs then take their last known
+    cost plus note**2 + beta for every note since, the cost of matching those
+    notes as duplicates and so an upper bound: a slow shard never wins on stale
+    costs. A shard gets its next notes once it has answered the previous ones,
+    all of those sung meanwhile in one request, so it falls behind by a few
+    notes at most. Late answers are picked up with the next note, which scores
+    the notes they cover again, and sync waits for them. A shard that
+    disconnects is dropped, its songs get the capped cost of 10000; one that
+    fails a request is dropped too and the error raised as a RuntimeError.
+    lagging lists the shards behind on the last note
+    '''
+    def __init__(self, addresses, timeout=0.005, window=None, batch=64, requestTimeout=10.0, rhythmWeight=None):
+        self._SONGNOTINDBSTR = 'Others'
+        self.timeout = timeout
+        self.requestTimeout = requestTimeout
+        self.window = window
+        self.batch = batch
+        self.avgWeight = 0.5
+        self.notDBCost = 3
+        self.beta = 5 # duplicate fix cost of the shard matchers
+        self.session = '%x-%x' % (id(self), int(time.time() * 1e6))
+        self._ids = 0
+        self._epoch = 0
+        self._errors = []
+        self._counter = 0
+        # the notes from _base on, _base being the oldest note some shard has
+        # not answered, with their cost rows and the running total of
+        # note**2 + beta. Late answers score them again from _baseLogprob
+        self._base = 0
+        self._notes = []
+        self._ratios = []
+        self._rows = []
+        self._penalty = [0]
+        self._late = False
+        self._selector = selectors.DefaultSelector()
+        self.links = []
+        self.songNames = []
+        for address in addresses:
+            sock = socket.create_connection(address, requestTimeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(False)
+            link = _ShardLink(tuple(address), len(self.songNames), sock)
+            self._selector.register(sock, link.events, link)
+            self.links.append(link)
+            self.songNames += self._request(link, {'op': 'songs'}, requestTimeout)['songs']
+            self._request(link, {'op': 'open', 'session': self.session, 'window': window,
+                                 'rhythmWeight': rhythmWeight}, requestTimeout)
+        self.songIndex = {name: j for j, name in enumerate(self.songNames)}
+        assert(len(self.songIndex) == len(self.songNames)), "SONGSMATCHREMOTE, song names repeat across shards"
+        nsong = len(self.songNames)
+        bounds = [link.lo for link in self.links] + [nsong]
+        for link, hi in zip(self.links, bounds[1:]):
+            link.latest = np.zeros(hi - link.lo, dtype=np.int32)
+        self._initPosterior(nsong) # last entry is Others
+        self._baseLogprob = self.logprob.copy()
+        self.cost = np.zeros(nsong, dtype=np.int32)
+        self.probDic = NameView(self.songIndex, self.prob, self._SONGNOTINDBSTR)
+        self.newprobDic = NameView(self.songIndex, self.newprob, self._SONGNOTINDBSTR)
+        self.lagging = []
+        self.t = []
+        self._tdropped = 0 # notes trimmed off the front of t
+        self._resetPending = False
+
+    def close(self):
+        '''
+        end the session on every shard and disconnect
+        '''
+        for link in self.links:
+            if not link.down:
+                self._post(link, {'op': 'close', 'session': self.session})
+            if not link.down:
+                self._drop(link)
+        self._selector.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _post(self, link, request):
+        # queue without waiting, the reply is handled when it comes in
+        self._ids += 1
+        request['id'] = self._ids
+        link.expected[self._ids] = (request['op'], self._epoch)
+        link.out += _encode(request)
+        self._write(link)
+        return self._ids
+
+    def _write(self, link):
+        # send what the socket takes now, the rest once it is writable again
+        try:
+            if link.out:
+                del link.out[:link.sock.send(link.out)]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._drop(link)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if link.out else 0)
+        if events != link.events:
+            link.events = events
+            self._selector.modify(link.sock, events, link)
+
+    def _sendNotes(self, link, pipeline=False):
+        # send the shard the notes it has not been sent, when it has answered
+        # the earlier ones; everything at once with pipeline
+        while not link.down and link.sent < self._base + len(self._notes) and (pipeline or link.sent == link.count):
+            k = link.sent - self._base
+            notes = self._notes[k:k + self.batch]
+            self._post(link, {'op': 'advance', 'sessions': [[self.session, link.sent, notes,
+                                                             self._ratios[k:k + self.batch]]]})
+            link.sent += len(notes)
+
+    def _drop(self, link):
+        link.down = True
+        if link.latest is not None:
+            link.latest = np.full(len(link.latest), 10000, dtype=np.int32)
+        link.out.clear()
+        self._selector.unregister(link.sock)
+        link.sock.close()
+        self._late = True # its songs were scored on bounds
+
+    def _fail(self, link, reply):
+        # a shard that could not carry out a request is out of step
+        self._errors.append("SONGSMATCHREMOTE, shard %s: %s" % (link.address, reply.get('error')))
+        self._drop(link)
+
+    def _raiseErrors(self):
+        if self._errors:
+            errors = self._errors
+            self._errors = []
+            raise RuntimeError('; '.join(errors))
+
+    def _receive(self, link):
+        try:
+            data = link.sock.recv(1 << 20)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(link)
+            return
+        link.buf += data
+        while True:
+            message = _parse(link.buf)
+            if message is None:
+                return
+            reply, payload = message
+            op, epoch = link.expected.pop(reply['id'])
+            if op == 'advance':
+                if epoch != self._epoch:
+                    continue # answer from before a reset
+                if not reply['ok']:
+                    self._fail(link, reply)
+                    return
+                rows = np.frombuffer(payload, dtype='<i4').reshape(-1, len(link.latest))
+                first = link.count
+                link.count = reply['counts'][0]
+                link.latest = rows[-1]
+                for k, row in enumerate(rows):
+                    self._rows[first + k - self._base][link.lo:link.lo + len(row)] = row
+                if first < self._counter:
+                    self._late = True # notes already scored on bounds
+                self._sendNotes(link)
+            elif op in ('songs', 'open', 'index', 'align'):
+                link.replies[reply['id']] = reply
+            elif op != 'late' and not reply['ok']:
+                self._fail(link, reply)
+                return
+
+    def _select(self, timeout):
+        # send and read what the sockets are ready for
+        for key, events in self._selector.select(timeout):
+            link = key.data
+            if events & selectors.EVENT_WRITE and not link.down:
+                self._write(link)
+            if events & selectors.EVENT_READ and not link.down:
+                self._receive(link)
+
+    def _wait(self, done, deadline):
+        # send and read until done() or the deadline
+        while not done():
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 or not self._selector.get_map():
+                return False
+            self._select(remaining)
+        return True
+
+    def _request(self, link, request, timeout):
+        # the reply to request, after every note sent so far
+        if link.down:
+            raise ConnectionError("SONGSMATCHREMOTE, shard %s is down" % (link.address,))
+        self._sendNotes(link, True)
+        rid = self._post(link, request)
+        self._wait(lambda: rid in link.replies or link.down, time.perf_counter() + timeout)
+        if link.down:
+            raise ConnectionError("SONGSMATCHREMOTE, shard %s is down" % (link.address,))
+        if rid not in link.replies:
+            link.expected[rid] = ('late', self._epoch)
+            raise TimeoutError("SONGSMATCHREMOTE, shard %s did not answer within %gs" % (link.address, timeout))
+        reply = link.replies.pop(rid)
+        if not reply['ok']:
+            raise RuntimeError("SONGSMATCHREMOTE, shard %s: %s" % (link.address, reply.get('error')))
+        return reply
+
+    def _link(self, songname):
+        assert(songname in self.songIndex), "SONGSMATCHREMOTE, invalid song name"
+        j = self.songIndex[songname]
+        for link in reversed(self.links):
+            if link.lo <= j:
+                return link
+
+    def reset(self):
+        '''
+        start matching from scratch, as a newly built matcher
+        '''
+        self._epoch += 1
+        for link in self.links:
+            if not link.down:
+                self._post(link, {'op': 'reset', 'session': self.session})
+                link.count = 0
+                link.sent = 0
+                link.latest = np.zeros(len(link.latest), dtype=np.int32)
+        self.t = []
+        self._tdropped = 0
+        self._counter = 0
+        self._base = 0
+        self._notes = []
+        self._ratios = []
+        self._rows = []
+        self._penalty = [0]
+        self._late = False
+        self.lagging = []
+        self._resetPending = True
+
+    def _applyReset(self):
+        if not self._resetPending:
+            return
+        self._resetPending = False
+        self.cost.fill(0)
+        self._resetPosterior()
+        self._baseLogprob[:] = self.logprob
+
+    def trimHistory(self, nkeep):
+        '''
+        keep only the last nkeep notes, see SongMatchNew.trimHistory
+        '''
+        assert(nkeep >= 1), "SONGSMATCHREMOTE, trimHistory must keep at least one note"
+        for link in self.links:
+            self._sendNotes(link, True)
+            if not link.down:
+                self._post(link, {'op': 'trim', 'session': self.session, 'nkeep': nkeep})
+        self._trimNotes(nkeep)
+
+    def _trimNotes(self, nkeep):
+        drop = len(self.t) - nkeep
+        if drop > 0:
+            del self.t[:drop]
+            self._tdropped += drop
+
+    def _score(self, last):
+        # cost rows and posterior of the notes up to last, from _base when
+        # late answers came in. Songs of a shard that has not answered a note
+        # get their upper bound
+        first = self._counter
+        if self._late:
+            self._late = False
+            first = self._base
+            self.logprob[:] = self._baseLogprob
+            np.exp(self.logprob, out=self.prob)
+        base = self._base
+        settled = min([link.count for link in self.links if not link.down] + [last])
+        for n in range(first + 1, last + 1):
+            row = self._rows[n - base - 1]
+            for link in self.links:
+                if n > link.count:
+                    cost = row[link.lo:link.lo + len(link.latest)]
+                    if link.down:
+                        cost[:] = link.latest
+                    else:
+                        extra = self._penalty[n - base] - self._penalty[link.count - base]
+                        np.minimum(link.latest + extra, 10000, out=cost)
+            self.cost[:] = row
+            self._counter = n
+            self._updatePosterior(self.cost)
+            if n == settled:
+                self._baseLogprob[:] = self.logprob
+        # every shard has answered the notes up to settled
+        drop = settled - base
+        del self._notes[:drop], self._ratios[:drop], self._rows[:drop], self._penalty[:drop]
+        self._base = settled
+
+    def addNote(self, note, ratio=None):
+        assert(len(note) == 1), "SONGSMATCHREMOTE, addNote argument length is not 1!"
+        return self.addNotes(note, [ratio])
+
+    def addNotes(self, notes, ratios=None):
+        # return the match value for the last note
+        assert(len(notes) > 0), "SONGSMATCHREMOTE, addNotes argument length is 0!"
+        self._applyReset()
+        notes = [int(x) for x in notes]
+        if ratios is None:
+            ratios = [None] * len(notes)
+        ratios = [None if r is None else float(r) for r in ratios]
+        for first in range(0, len(notes), self.batch):
+            chunk = notes[first:first + self.batch]
+            target = self._counter + len(chunk)
+            self._notes += chunk
+            self._ratios += ratios[first:first + self.batch]
+            for note in chunk:
+                self._penalty.append(self._penalty[-1] + note ** 2 + self.beta)
+                self._rows.append(np.zeros(len(self.cost), dtype=np.int32))
+            # only the shards caught up before these notes are waited for,
+            # counting the answers that came in since the last note
+            if self._selector.get_map():
+                self._select(0)
+            ready = [link for link in self.links if not link.down and link.count == self._counter]
+            for link in self.links:
+                self._sendNotes(link)
+            self._wait(lambda: all(link.down or link.count >= target for link in ready),
+                       time.perf_counter() + self.timeout)
+            self._score(target)
+            self.t += chunk
+        self.lagging = [link.address for link in self.links if not link.down and link.count < self._counter]
+        if self.window is not None:
+            self._trimNotes(self.window)
+        self._raiseErrors()
+        return dict(zip(self.songNames, self.cost.tolist()))
+
+    def sync(self, timeout=None):
+        '''
+        wait up to timeout seconds (requestTimeout by default) for the shards
+        left behind, and score the notes they answer again. Returns True when
+        every shard has answered every note
+        '''
+        self._applyReset()
+        timeout = self.requestTimeout if timeout is None else timeout
+        live = [link for link in self.links if not link.down]
+        for link in live:
+            self._sendNotes(link, True)
+        self._wait(lambda: all(link.down or link.count >= self._counter for link in live),
+                   time.perf_counter() + timeout)
+        self._score(self._counter)
+        self.lagging = [link.address for link in self.links if not link.down and link.count < self._counter]
+        self._raiseErrors()
+        return not self.lagging
+
+    def getProbDic(self):
+        '''
+        return the dictionary of probability, a read-only view of self.prob
+        '''
+        self._applyReset()
+        return self.probDic
+
+    def getMatchIndex(self, songname):
+        '''
+        return the song row where the best alignment of songname ends, waits
+        up to timeout for the shard of the song to catch up
+        '''
+        link = self._link(songname)
+        return self._request(link, {'op': 'index', 'session': self.session, 'song': songname}, self.timeout)['index']
+
+    def _alignment(self, songname):
+        link = self._link(songname)
+        reply = self._request(link, {'op': 'align', 'session': self.session, 'song': songname}, self.timeout)
+        return reply['s'], reply['stime'], np.array(reply['sidx'], dtype=np.int64), reply['droppedSum']
+
+    def getKeyTempo(self, songname, sfkey, tfkey, ttime):
+        assert(len(ttime) == len(self.t) + 1), "SONGSMATCHREMOTE, getKeyTempo timelist and counter mismatch"
+        s, stime, sidx, droppedSum = self._alignment(songname)
+        diffmat = np.stack((sidx, np.arange(1, len(sidx) + 1)), axis=1)
+        return keyTempo(s, stime, self.t, diffmat, sfkey, tfkey + droppedSum, ttime)
+
+    def getKeyTempoTracker(self, songname, sfkey, tfkey, durations):
+        '''
+        see SongMatchNew.getKeyTempoTracker, further notes are fed with getMatchIndex
+        '''
+        assert(len(durations) == len(self.t) + 1), "SONGSMATCHREMOTE, getKeyTempoTracker durations and counter mismatch"
+        s, stime, sidx, droppedSum = self._alignment(songname)
+        tracker = KeyTempoTracker(np.asarray(s), stime, sfkey, tfkey + droppedSum, durations[0])
+        for interval, j, duration in zip(self.t, sidx, durations[1:]):
+            tracker.addNote(interval, j, duration)
+        return tracker
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="serve a shard of the song catalog")
+    parser.add_argument('--port', type=int, default=0, help="serve these musicbank songs on this port")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('songs', nargs='*')
+    parser.add_argument('--local', type=int, default=3, help="number of localhost shards for the self test, "
+                                                             "which also runs with 2")
+    args = parser.parse_args()
+    if args.songs:
+        serveSongs(args.songs, (args.host, args.port))
+    else:
+        from songindex import syntheticCatalog, noisyQuery
+        rng = np.random.RandomState(3)
+        dic = syntheticCatalog(3000)
+        names = list(dic)
+        q = noisyQuery(dic[names[rng.randint(len(names))]], 30, rng)
+        single = SongsMatchBatch(dic)
+        single.addNotes(q)
+        for nshards in sorted(set([2, args.local])):
+            # the last shard answers after 0.2s, 40 times the timeout
+            delays = [0.0] * (nshards - 1) + [0.2]
+            for label, d in (("all shards on time", [0.0] * nshards), ("one slow shard", delays)):
+                with LocalShards(dic, nshards, delays=d) as shards, SongsMatchRemote(shards.addresses) as remote:
+                    latency = []
+                    for x in q:
+                        time.sleep(0.05) # a fast singer
+                        t0 = time.perf_counter()
+                        remote.addNote([x])
+                        latency.append(time.perf_counter() - t0)
+                    print("%d shards, %s: per-note median %.1fms, max %.1fms, %d lagging, best %s (single matcher %s)"
+                          % (nshards, label, 1e3*np.median(latency), 1e3*max(latency), len(remote.lagging),
+                             remote.best()[0], single.best()[0]))
+                    remote.sync()
+                    print("  after sync: best %s, same probabilities: %s" % (remote.best()[0],
+                          np.array_equal(remote.getProbs(), single.getProbs())))
@@ -0,0 +1,276 @@
+"""
+Catalog matching spread over several processes. Every worker owns a
+contiguous shard of the songs and runs its own matcher over it; notes are
+broadcast to the workers through pipes, the per-song costs come back through
+one shared memory block, and the posterior over the whole catalog (and the
+Others entry) is computed in the parent, as a single matcher would.
+"""
+import multiprocessing
+import weakref
+import numpy as np
+from multiprocessing import shared_memory
+from songmatch import SongsMatchBatch, NameView, _Posterior
+
+def _serveShard(conn, shmname, shape, lo, hi, dic, timedic, matcherClass, window, rhythmWeight):
+    shm = shared_memory.SharedMemory(name=shmname)
+    costs = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    matcher = matcherClass(dic, timedic, window=window, rhythmWeight=rhythmWeight)
+    try:
+        while True:
+            cmd, args = conn.recv()
+            if cmd == 'close':
+                break
+            try:
+                if cmd == 'notes':
+                    # one row of costs per note, written to this shard's columns
+                    notes, ratios = args
+                    for k, (note, ratio) in enumerate(zip(notes, ratios)):
+                        matcher.addNote([note], ratio)
+                        costs[k, lo:hi] = matcher.cost
+                    result = None
+                else:
+                    result = getattr(matcher, cmd)(*args)
+            except Exception as e:
+                conn.send((False, e))
+            else:
+                conn.send((True, result))
+    finally:
+        del costs
+        shm.close()
+        conn.close()
+
+def _shutdown(conns, procs, shm):
+    for conn in conns:
+        try:
+            conn.send(('close', ()))
+        except (OSError, ValueError):
+            pass
+    for proc in procs:
+        proc.join(5)
+        if proc.is_alive():
+            proc.terminate()
+    for conn in conns:
+        conn.close()
+    shm.close()
+    shm.unlink()
+
+class SongsMatchSharded(_Posterior):
+    '''
+    Drop-in alternative to SongsMatchNew running matcherClass over nshards
+    slices of the catalog, one worker process each. Shards are balanced by total
+    melody length. getProbDic is the same as for a single matcherClass over the
+    whole catalog. addNotes sends a whole batch of notes in one message, up to
+    batch notes at a time; a shard failing on them resets the matcher and the
+    error is raised. Call close (or use it in a with block) to stop the
+    workers
+    '''
+    def __init__(self, dic, timedic={}, nshards=None, matcherClass=SongsMatchBatch, window=None, batch=64,
+                 rhythmWeight=None):
+        assert(len(dic) > 0), "SONGSMATCHSHARDED, song dictionary is empty!"
+        self._SONGNOTINDBSTR = 'Others'
+        self.songNames = list(dic)
+        self.songIndex = {name: j for j, name in enumerate(self.songNames)}
+        nsong = len(self.songNames)
+        if nshards is None:
+            nshards = multiprocessing.cpu_count()
+        nshards = max(1, min(nshards, nsong))
+        # shard k holds songs bounds[k]:bounds[k+1]
+        work = np.cumsum([len(dic[name]) + 1 for name in self.songNames])
+        cuts = np.searchsorted(work, work[-1] * np.arange(1, nshards) / nshards)
+        self.bounds = np.unique(np.concatenate(([0], cuts, [nsong]))).tolist()
+        self._shardOf = np.repeat(np.arange(len(self.bounds) - 1), np.diff(self.bounds))
+        self.batch = batch
+        self.window = window
+        self.avgWeight = 0.5
+        self.notDBCost = 3
+        self._shm = shared_memory.SharedMemory(create=True, size=batch * nsong * 8)
+        self._costs = np.ndarray([batch, nsong], dtype=np.float64, buffer=self._shm.buf)
+        self._conns = []
+        self._procs = []
+        for lo, hi in zip(self.bounds[:-1], self.bounds[1:]):
+            names = self.songNames[lo:hi]
+            shard = {name: dic[name] for name in names}
+            shardtime = {name: timedic[name] for name in names if name in timedic}
+            parent, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_serveShard, daemon=True,
+                args=(child, self._shm.name, (batch, nsong), lo, hi, shard, shardtime, matcherClass, window, rhythmWeight))
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+        self._closer = weakref.finalize(self, _shutdown, self._conns, self._procs, self._shm)
+        self._initPosterior(nsong) # last entry is Others
+        self.cost = np.zeros(nsong)
+        self.probDic = NameView(self.songIndex, self.prob, self._SONGNOTINDBSTR)
+        self.newprobDic = NameView(self.songIndex, self.newprob, self._SONGNOTINDBSTR)
+        self.t = []
+        self._tdropped = 0 # notes trimmed off the front of t
+        self._counter = 0
+        self._resetPending = False
+
+    def close(self):
+        '''
+        stop the worker processes and free the shared cost block
+        '''
+        self._closer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _gather(self, conns):
+        # every reply is read before raising, none is left in a pipe to be
+        # taken for the answer to a later call
+        replies = [conn.recv() for conn in conns]
+        for ok, result in replies:
+            if not ok:
+                raise result
+        return [result for ok, result in replies]
+
+    def _broadcast(self, cmd, *args):
+        assert(self._closer.alive), "SONGSMATCHSHARDED, matcher is closed"
+        for conn in self._conns:
+            conn.send((cmd, args))
+        return self._gather(self._conns)
+
+    def _ask(self, songname, cmd, *args):
+        assert(self._closer.alive), "SONGSMATCHSHARDED, matcher is closed"
+        conn = self._conns[self._shardOf[self.songIndex[songname]]]
+        conn.send((cmd, (songname,) + args))
+        return self._gather([conn])[0]
+
+    def reset(self):
+        '''
+        start matching from scratch, as a newly built matcher
+        '''
+        self._broadcast('reset')
+        self.t = []
+        self._tdropped = 0
+        self._counter = 0
+        self._resetPending = True
+
+    def _applyReset(self):
+        if not self._resetPending:
+            return
+        self._resetPending = False
+        self.cost.fill(0)
+        self._resetPosterior()
+
+    def snapshot(self):
+        '''
+        return a copy of the matching state, to be passed to restore
+        '''
+        self._applyReset()
+        return (self._broadcast('snapshot'), list(self.t), self._tdropped, self.cost.copy(),
+                self.logprob.copy(), self._counter)
+
+    def restore(self, state):
+        '''
+        go back to the matching state returned by snapshot
+        '''
+        shards, t, tdropped, cost, logprob, counter = state
+        assert(len(shards) == len(self._conns)), "SONGSMATCHSHARDED, restore state is from another sharding"
+        for conn, shard in zip(self._conns, shards):
+            conn.send(('restore', (shard,)))
+        self._gather(self._conns)
+        self._resetPending = False
+        self.t = list(t)
+        self._tdropped = tdropped
+        self.cost[:] = cost
+        self.logprob[:] = logprob
+        np.exp(self.logprob, out=self.prob)
+        self.newprob.fill(0)
+        self._counter = counter
+        self._ranked = None
+
+    def trimHistory(self, nkeep):
+        '''
+        keep only the last nkeep notes, see SongMatchNew.trimHistory
+        '''
+        assert(nkeep >= 1), "SONGSMATCHSHARDED, trimHistory must keep at least one note"
+        self._broadcast('trimHistory', nkeep)
+        self._trimNotes(nkeep)
+
+    def _trimNotes(self, nkeep):
+        drop = len(self.t) - nkeep
+        if drop > 0:
+            del self.t[:drop]
+            self._tdropped += drop
+
+    def addNote(self, note, ratio=None):
+        assert(len(note) == 1), "SONGSMATCHSHARDED, addNote argument length is not 1!"
+        return self.addNotes(note, [ratio])
+
+    def addNotes(self, notes, ratios=None):
+        # return the match value for the last note
+        assert(len(notes) > 0), "SONGSMATCHSHARDED, addNotes argument length is 0!"
+        self._applyReset()
+        notes = list(notes)
+        ratios = [None] * len(notes) if ratios is None else list(ratios)
+        for first in range(0, len(notes), self.batch):
+            chunk = notes[first:first + self.batch]
+            try:
+                self._broadcast('notes', chunk, ratios[first:first + self.batch])
+            except Exception:
+                # the shards that took the notes are ahead of the others
+                self.reset()
+                raise
+            for k, note in enumerate(chunk):
+                self.t.append(note)
+                self._counter += 1
+                self.cost[:] = self._costs[k]
+                self._updatePosterior(self.cost)
+        if self.window is not None:
+            self._trimNotes(self.window)
+        return dict(zip(self.songNames, self.cost.tolist()))
+
+    def getProbDic(self):
+        '''
+        return the dictionary of probability, a read-only view of self.prob
+        '''
+        self._applyReset()
+        return self.probDic
+
+    def getKeyTempo(self, songname, sfkey, tfkey, ttime):
+        assert(songname in self.songIndex), "SONGSMATCHSHARDED, getKeyTempo invalid song name"
+        return self._ask(songname, 'getKeyTempo', sfkey, tfkey, ttime)
+
+    def getKeyTempoTracker(self, songname, sfkey, tfkey, durations):
+        '''
+        see SongMatchNew.getKeyTempoTracker, the tracker is built in the worker
+        '''
+        assert(songname in self.songIndex), "SONGSMATCHSHARDED, getKeyTempoTracker invalid song name"
+        return self._ask(songname, 'getKeyTempoTracker', sfkey, tfkey, durations)
+
+    def getMatchIndex(self, songname):
+        '''
+        return the song row where the best alignment of songname ends
+        '''
+        return self._ask(songname, 'getMatchIndex')
+
+if __name__ == "__main__":
+    import time
+    from songindex import syntheticCatalog, noisyQuery
+    rng = np.random.RandomState(2)
+    for nsong in (1000, 20000):
+        dic = syntheticCatalog(nsong)
+        names = list(dic)
+        q = noisyQuery(dic[names[rng.randint(nsong)]], 30, rng)
+        single = SongsMatchBatch(dic)
+        tsingle = []
+        for x in q:
+            t0 = time.perf_counter()
+            single.addNote([x])
+            tsingle.append(time.perf_counter() - t0)
+        for nshards in sorted(set([2, multiprocessing.cpu_count()])):
+            with SongsMatchSharded(dic, nshards=nshards) as sharded:
+                tsharded = []
+                for x in q:
+                    t0 = time.perf_counter()
+                    sharded.addNote([x])
+                    tsharded.append(time.perf_counter() - t0)
+                same = np.array_equal(sharded.getProbs(), single.getProbs())
+                print("%d songs, %d shards: per-note median %.2fms (single process %.2fms), same probabilities: %s"
+                      % (nsong, len(sharded.bounds) - 1, 1e3*np.median(tsharded), 1e3*np.median(tsingle), same))
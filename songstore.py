@@ -0,0 +1,286 @@
+"""
+SQLite song library for catalogs too large for the musicbank text files:
+one row per song with its metadata and its intervals (float32) and
+timestamps (float64) as little endian BLOBs, and a tag table indexed by tag
+so a subset (a language, a genre) is read in one query:
+
+    store = SongStore('library.sqlite')
+    songs, timestamps = store.loadSubset(tags=['en'])
+    song_matcher = SongsMatchNew(songs, timestamps)
+
+SongStore has the getters of SongDatabase and can back one through its
+catalog argument. Import the musicbank and tag songs with
+    python songstore.py import library.sqlite [song names]
+    python songstore.py tag library.sqlite tag song names...
+"""
+import os
+import sqlite3
+from collections import OrderedDict
+import numpy as np
+from song import SONG_PATH, Timeline
+from songcatalog import musicbankSongs, _readFloats
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    first_note INTEGER NOT NULL DEFAULT 60,
+    mid TEXT,
+    wav TEXT,
+    intervals BLOB NOT NULL,
+    timestamps BLOB
+);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT NOT NULL,
+    song_id INTEGER NOT NULL REFERENCES songs(id) ON DELETE CASCADE,
+    PRIMARY KEY (tag, song_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tags_song ON tags(song_id);
+'''
+# most bound parameters per statement on older SQLite builds
+_MAX_VARIABLES = 900
+
+def _intervalBlob(intervals):
+    return np.asarray(intervals, dtype='<f4').tobytes()
+
+def _timestampBlob(timestamps):
+    if timestamps is None or len(timestamps) == 0:
+        return None
+    return np.asarray(timestamps, dtype='<f8').tobytes()
+
+def _intervals(blob):
+    return np.frombuffer(blob, dtype='<f4')
+
+def _timestamps(blob):
+    return np.frombuffer(blob, dtype='<f8') if blob is not None else np.zeros(0)
+
+class SongStore(object):
+    """
+    SongDatabase backend over an SQLite file, created when missing. Melodies
+    and timestamps are read-only arrays over the fetched BLOBs. The Timelines
+    of the cacheSize most recently used songs are kept
+    """
+    def __init__(self, filename, songPath=SONG_PATH, cacheSize=32):
+        self.filename = filename
+        self.songPath = songPath
+        self.cacheSize = cacheSize
+        self._db = sqlite3.connect(filename)
+        self._db.execute('PRAGMA foreign_keys = ON')
+        self._db.executescript(_SCHEMA)
+        self._timelines = OrderedDict()
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # import
+
+    def importSongs(self, songs):
+        '''
+        insert or update songs, an iterable of (name, intervals, timestamps),
+        in one transaction. Returns the number of songs
+        '''
+        rows = ((name, os.path.join(self.songPath, name + '.mid'), os.path.join(self.songPath, name + '.wav'),
+                 _intervalBlob(intervals), _timestampBlob(timestamps)) for name, intervals, timestamps in songs)
+        with self._db:
+            before = self._db.total_changes
+            self._db.executemany('INSERT INTO songs (name, mid, wav, intervals, timestamps) VALUES (?, ?, ?, ?, ?) '
+                                 'ON CONFLICT(name) DO UPDATE SET mid = excluded.mid, wav = excluded.wav, '
+                                 'intervals = excluded.intervals, timestamps = excluded.timestamps', rows)
+            count = self._db.total_changes - before
+        return count
+
+    def importMusicbank(self, allSongNames=None, songPath=None, tags=()):
+        '''
+        import the _stripped.txt and _timestamps.txt files of allSongNames
+        (every song of songPath by default), tagged with tags
+        '''
+        songPath = self.songPath if songPath is None else songPath
+        if allSongNames is None:
+            allSongNames = musicbankSongs(songPath)
+        def read():
+            for name in allSongNames:
+                timefile = os.path.join(songPath, name + '_timestamps.txt')
+                yield (name, _readFloats(os.path.join(songPath, name + '_stripped.txt')),
+                       _readFloats(timefile) if os.path.exists(timefile) else None)
+        count = self.importSongs(read())
+        if tags:
+            self.addTags(allSongNames, tags)
+        return count
+
+    def addTags(self, names, tags):
+        '''
+        tag every song of names with every tag of tags
+        '''
+        with self._db:
+            for chunk in self._chunks(list(names)):
+                ids = self._db.execute('SELECT id FROM songs WHERE name IN (%s)' % ','.join('?' * len(chunk)),
+                                       chunk).fetchall()
+                self._db.executemany('INSERT OR IGNORE INTO tags (tag, song_id) VALUES (?, ?)',
+                                     [(tag, i) for tag in tags for i, in ids])
+
+    def removeTags(self, names, tags):
+        with self._db:
+            for chunk in self._chunks(list(names), _MAX_VARIABLES - 1):
+                self._db.executemany('DELETE FROM tags WHERE tag = ? AND song_id IN (SELECT id FROM songs WHERE '
+                                     'name IN (%s))' % ','.join('?' * len(chunk)), [[tag] + chunk for tag in tags])
+
+    # queries
+
+    def _chunks(self, values, size=_MAX_VARIABLES):
+        for first in range(0, len(values), size):
+            yield values[first:first + size]
+
+    def _where(self, names=None, ids=None, tags=None):
+        # WHERE clause and parameters selecting songs by name, id and having
+        # every tag of tags
+        clauses = []
+        params = []
+        if names is not None:
+            clauses.append('name IN (%s)' % ','.join('?' * len(names)))
+            params += list(names)
+        if ids is not None:
+            clauses.append('id IN (%s)' % ','.join('?' * len(ids)))
+            params += [int(i) for i in ids]
+        if tags:
+            tags = list(set(tags))
+            clauses.append('id IN (SELECT song_id FROM tags WHERE tag IN (%s) GROUP BY song_id HAVING COUNT(*) = ?)'
+                           % ','.join('?' * len(tags)))
+            params += tags + [len(tags)]
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def _select(self, columns, names=None, ids=None, tags=None):
+        # long names and ids lists are queried in chunks, every statement
+        # binding at most _MAX_VARIABLES parameters with those of the tags
+        size = _MAX_VARIABLES - (len(set(tags)) + 1 if tags else 0)
+        if names is not None and ids is not None:
+            size //= 2
+        assert(size > 0), "SONGSTORE, too many tags in one query"
+        for nameChunk in (self._chunks(list(names), size) if names is not None else [None]):
+            for idChunk in (self._chunks(list(ids), size) if ids is not None else [None]):
+                where, params = self._where(nameChunk, idChunk, tags)
+                for row in self._db.execute('SELECT %s FROM songs%s ORDER BY id' % (columns, where), params):
+                    yield row
+
+    def getNumSongs(self, tags=None):
+        where, params = self._where(tags=tags)
+        return self._db.execute('SELECT COUNT(*) FROM songs' + where, params).fetchone()[0]
+
+    def songNames(self, tags=None):
+        '''
+        names of the songs (having every tag of tags), by id
+        '''
+        return [name for name, in self._select('name', tags=tags)]
+
+    def songIds(self, names):
+        '''
+        {name: id} of the songs of names in the store
+        '''
+        return dict(self._select('name, id', names=list(names)))
+
+    def tags(self, songname=None):
+        '''
+        every tag, or the tags of songname, sorted
+        '''
+        if songname is None:
+            return [tag for tag, in self._db.execute('SELECT DISTINCT tag FROM tags ORDER BY tag')]
+        return [tag for tag, in self._db.execute('SELECT tag FROM tags JOIN songs ON songs.id = song_id '
+                                                 'WHERE name = ? ORDER BY tag', (songname,))]
+
+    def loadSubset(self, names=None, ids=None, tags=None):
+        '''
+        (melodies, timestamps) dictionaries by name of the songs selected by
+        names, ids and tags (every song when none is given), as the matchers
+        take them. Songs without timestamps are left out of timestamps
+        '''
+        melodies = {}
+        timestamps = {}
+        for name, intervals, times in self._select('name, intervals, timestamps', names, ids, tags):
+            melodies[name] = _intervals(intervals)
+            if times is not None:
+                timestamps[name] = _timestamps(times)
+        return melodies, timestamps
+
+    def iterSongs(self, chunk=1000, names=None, ids=None, tags=None):
+        '''
+        yield the selected songs as lists of up to chunk (id, name, intervals,
+        timestamps), without holding the whole library in memory
+        '''
+        rows = self._select('id, name, intervals, timestamps', names, ids, tags)
+        while True:
+            batch = []
+            for row in rows:
+                i, name, intervals, times = row
+                batch.append((i, name, _intervals(intervals), _timestamps(times)))
+                if len(batch) == chunk:
+                    break
+            if not batch:
+                return
+            yield batch
+
+    # SongDatabase getters
+
+    def _column(self, songname, column):
+        row = self._db.execute('SELECT %s FROM songs WHERE name = ?' % column, (songname,)).fetchone()
+        assert(row is not None), "SONGSTORE, unknown song %s" % songname
+        return row[0]
+
+    def getMelody(self, songname):
+        return _intervals(self._column(songname, 'intervals'))
+
+    def getAllMelody(self):
+        return self.loadSubset()[0]
+
+    def getTimestamps(self, songname):
+        return _timestamps(self._column(songname, 'timestamps'))
+
+    def getAllTimestamps(self):
+        return self.loadSubset()[1]
+
+    def getFirstNote(self, songname):
+        return self._column(songname, 'first_note')
+
+    def getAllFirstNode(self):
+        return dict(self._select('name, first_note'))
+
+    def getTimeline(self, songname):
+        # LRU of cacheSize
+        timeline = self._timelines.get(songname)
+        if timeline is None:
+            timeline = self._timelines[songname] = Timeline(self.getTimestamps(songname))
+            if len(self._timelines) > self.cacheSize:
+                self._timelines.popitem(last=False)
+        else:
+            self._timelines.move_to_end(songname)
+        return timeline
+
+    def getNumNotesBefore(self, songname, timestamp):
+        return self.getTimeline(songname).numNotesBefore(timestamp)
+
+    def getMIDI(self, songname):
+        return self._column(songname, 'mid')
+
+    def getWAV(self, songname):
+        return self._column(songname, 'wav')
+
+if __name__ == "__main__":
+    import sys
+    import time
+    if len(sys.argv) >= 3 and sys.argv[1] == 'import':
+        t0 = time.perf_counter()
+        with SongStore(sys.argv[2]) as store:
+            count = store.importMusicbank(sys.argv[3:] or None)
+            print("%d songs imported, %d in %s, in %.2fs" % (count, store.getNumSongs(), sys.argv[2],
+                  time.perf_counter() - t0))
+    elif len(sys.argv) >= 5 and sys.argv[1] == 'tag':
+        with SongStore(sys.argv[2]) as store:
+            store.addTags(sys.argv[4:], [sys.argv[3]])
+            print("%d songs tagged %s" % (store.getNumSongs(tags=[sys.argv[3]]), sys.argv[3]))
+    else:
+        print("usage: python songstore.py import library.sqlite [song names]\n"
+              "       python songstore.py tag library.sqlite tag song names...")